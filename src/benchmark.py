@@ -0,0 +1,260 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Microbenchmarks, run with `python benchmark.py <name>`
+"""
+
+import argparse
+import timeit
+import random
+import subprocess
+import sys
+import os
+from colorama import Fore, Back, Style
+import helpers
+from command_lib import Command, CommandSet
+from standard_command_set import StandardCommandSet
+from headless import HeadlessScreen, HeadlessPen
+
+
+def _legacy_parse_ansi(string: str):
+    """Character-at-a-time parser that App.add_to_console used before helpers.parse_ansi, kept for comparison"""
+    segments = []
+    segment = ""
+    fmt = "normal"
+    fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
+    back_color = None
+    building_ansi = False
+    building_text = True
+    ansi_in_progress = ""
+    for char in string:
+        if char == "\x1b":
+            if building_text:
+                segments.append((segment, fmt, fore_color, back_color))
+                segment = ""
+            building_ansi = True
+            building_text = False
+            ansi_in_progress = char
+        elif building_ansi:
+            ansi_in_progress += char
+            if char == "m":
+                if ansi_in_progress == Style.NORMAL:
+                    fmt = "normal"
+                elif ansi_in_progress == Style.BRIGHT:
+                    fmt = "bold"
+                elif ansi_in_progress == Style.DIM:
+                    fmt = "italic"
+                elif ansi_in_progress == Style.RESET_ALL:
+                    fmt = "normal"
+                    fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
+                    back_color = None
+                elif ansi_in_progress == Fore.RESET:
+                    fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
+                elif ansi_in_progress == Back.RESET:
+                    back_color = None
+                else:
+                    kind, color = helpers.ansi_to_hex(ansi_in_progress)
+                    if kind == 0:
+                        fore_color = color
+                    else:
+                        back_color = color
+                building_ansi = False
+        elif not building_text:
+            building_text = True
+        if building_text:
+            segment += char
+    if building_text:
+        segments.append((segment, fmt, fore_color, back_color))
+    return segments
+
+
+def _console_lines():
+    """Lines shaped like what help and history replay send to the console"""
+    return [
+        f"{Fore.LIGHTBLACK_EX}>>{Fore.LIGHTWHITE_EX} forward 50{Style.RESET_ALL}\n",
+        f"{Style.BRIGHT}{Fore.GREEN}koch_snowflake{Fore.BLUE} sides depth scale{Style.RESET_ALL}\n\t{Fore.CYAN}Plot a "
+        f"{Fore.BLUE}{Style.BRIGHT}sides{Fore.CYAN}{Style.NORMAL} sided koch snowflake fractal{Style.RESET_ALL}\n",
+        helpers.error_format("Something went wrong while executing that command:\n\tInvalidCommandError: nope") + "\n",
+        f"{Back.RED}{Fore.LIGHTYELLOW_EX}warning{Back.RESET} plain text after{Style.RESET_ALL}\n",
+    ] * 250
+
+
+def bench_console(repeat: int):
+    lines = _console_lines()
+    for name, parse in [("before (char walk)", _legacy_parse_ansi), ("after (regex)", helpers.parse_ansi)]:
+        seconds = min(timeit.repeat(lambda: [parse(line) for line in lines], number=1, repeat=repeat))
+        print(f"{name:>20}: {len(lines) / seconds:12,.0f} lines/s")
+    # Tag count: previously one new tag per segment, now one per distinct formatting
+    segments = [segment for line in lines for segment in helpers.parse_ansi(line)]
+    print(f"{'tags before':>20}: {len(segments):12,}")
+    print(f"{'tags after':>20}: {len({segment[1:] for segment in segments}):12,}")
+
+
+def _script(length: int):
+    """Random mix of drawing commands, in the shapes users type them"""
+    rng = random.Random(0)
+    templates = [
+        lambda: "forward", lambda: f"forward {rng.randint(1, 100)}", lambda: f"back {rng.randint(1, 100)}",
+        lambda: f"backward {rng.randint(1, 100)}", lambda: f"left {rng.randint(0, 360)}", lambda: "right",
+        lambda: f"goto {rng.randint(-300, 300)} {rng.randint(-300, 300)}", lambda: "penup", lambda: "pendown",
+        lambda: f"snow {rng.randint(3, 8)} 2 0.5", lambda: f"poly {rng.randint(1, 50)} {rng.randint(3, 9)}",
+        lambda: "color red", lambda: f"width {rng.randint(1, 5)}"
+    ]
+    return [rng.choice(templates)() for _ in range(length)]
+
+
+def _dispatch_command_set() -> CommandSet:
+    """CommandSet with the standard command signatures and no-op callbacks, so only dispatch is measured"""
+    command_set = CommandSet(lambda string: None, None)
+
+    def noop(*args):
+        pass
+    for name, types in [("penup", []), ("pendown", []), ("forward", []), ("forward", [int]), ("back", []),
+                        ("back", [int]), ("right", []), ("right", [int]), ("left", []), ("left", [int]),
+                        ("circle", [float]), ("polygon", [float, int]), ("koch_snowflake", []),
+                        ("koch_snowflake", [int, float]), ("koch_snowflake", [int, float, float]),
+                        ("color", [str]), ("width", [int]), ("goto", [int, int])]:
+        command_set.register(Command(name, "", len(types), types, noop))
+    command_set.alias("back", "backward")
+    command_set.alias("polygon", "poly")
+    command_set.alias("koch_snowflake", "snowflake")
+    command_set.alias("snowflake", "snow")
+    return command_set
+
+
+def bench_dispatch(repeat: int):
+    command_set = _dispatch_command_set()
+    script = _script(20000)
+    seconds = min(timeit.repeat(lambda: [command_set._execute(line) for line in script], number=1, repeat=repeat))
+    print(f"{'dispatch':>20}: {len(script) / seconds:12,.0f} commands/s")
+
+
+def _standard_command_set(pen, screen) -> StandardCommandSet:
+    return StandardCommandSet(pen, screen, lambda: None, lambda string: None, lambda: None)
+
+
+def bench_headless(repeat: int):
+    script = "\n".join(_script(2000))
+
+    def run_headless():
+        screen = HeadlessScreen()
+        _standard_command_set(HeadlessPen(screen), screen).run_script(script)
+    seconds = min(timeit.repeat(run_headless, number=1, repeat=repeat))
+    print(f"{'headless':>20}: {2000 / seconds:12,.0f} commands/s")
+
+    try:
+        import tkinter as tk
+        import turtle
+        from screens import CanvasScreen
+        root = tk.Tk()
+    except Exception as e:  # noqa
+        print(f"{'tk':>20}: skipped, {helpers.error_string(e)}")
+        return
+    canvas = tk.Canvas(root, width=600, height=600)
+    canvas.pack()
+    screen = CanvasScreen(canvas)
+    command_set = _standard_command_set(turtle.RawTurtle(screen), screen)
+    seconds = min(timeit.repeat(lambda: (command_set.user_input("reset"), command_set.run_script(script)),
+                                number=1, repeat=repeat))
+    print(f"{'tk':>20}: {2000 / seconds:12,.0f} commands/s")
+    root.destroy()
+
+
+_FIRST_FRAME_SCRIPT = """
+import time
+start = time.perf_counter()
+import tkinter as tk
+import settings
+settings.Settings.has_accepted_license = lambda self: True  # The license dialog would wait for a click
+import main
+root = tk.Tk()
+app = main.App(root)
+finish_startup = app.finish_startup
+
+def shown():
+    print("frame", time.perf_counter() - start)
+
+def finished():
+    finish_startup()
+    print("ready", time.perf_counter() - start)
+    root.destroy()
+
+app.finish_startup = finished
+app.canvas.bind("<Map>", lambda event: root.after_idle(shown))
+root.mainloop()
+"""
+
+
+def _run_python(*arguments: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *arguments], capture_output=True, text=True, timeout=120,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_startup(repeat: int):
+    best = None
+    for _ in range(repeat):
+        process = _run_python("-X", "importtime", "-c", "import main")
+        if process.returncode != 0:
+            print(f"{'import main':>20}: failed, {process.stderr.strip().splitlines()[-1]}")
+            return
+        imports = []  # (depth, cumulative microseconds, module), a module is listed after everything it imports
+        for line in process.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            imports.append(((len(name) - len(name.lstrip()) - 1) // 2, int(cumulative), name.strip()))
+        main_index = max(i for i, (depth, _, name) in enumerate(imports) if depth == 0 and name == "main")
+        direct = []  # Modules imported by main itself
+        for depth, cumulative, name in reversed(imports[:main_index]):
+            if depth == 0:
+                break
+            if depth == 1:
+                direct.append((cumulative, name))
+        if best is None or imports[main_index][1] < best[0]:
+            best = (imports[main_index][1], direct)
+    total, direct = best
+    print(f"{'import main':>20}: {total / 1000:12,.1f} ms")
+    for cumulative, name in sorted(direct, reverse=True)[:8]:
+        print(f"{name:>20}: {cumulative / 1000:12,.1f} ms")
+
+    times = {}
+    for _ in range(repeat):
+        process = _run_python("-c", _FIRST_FRAME_SCRIPT)
+        if process.returncode != 0:
+            print(f"{'first frame':>20}: skipped, {process.stderr.strip().splitlines()[-1]}")
+            return
+        for line in process.stdout.splitlines():
+            label, _, seconds = line.partition(" ")
+            if label in ("frame", "ready"):
+                times[label] = min(times.get(label, float("inf")), float(seconds))
+    print(f"{'first frame':>20}: {times['frame'] * 1000:12,.1f} ms")
+    print(f"{'fonts loaded':>20}: {times['ready'] * 1000:12,.1f} ms")
+
+
+BENCHMARKS = {
+    "console": bench_console,
+    "dispatch": bench_dispatch,
+    "headless": bench_headless,
+    "startup": bench_startup
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a microbenchmark")
+    parser.add_argument("name", choices=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+    BENCHMARKS[arguments.name](arguments.repeat)
@@ -17,29 +17,41 @@ Copyright (C) 2022  Sam Wagenaar
 __all__ = ["TurtleCallbacks"]
 
 import typing
+import contextlib
 import turtle
 import time
 import random
-import math
-from helpers import random_color
+import sys
+import os
+from array import array
+from checkpoints import Checkpoint, pen_state, apply_pen_state
+from settings import Settings, render_tracer
+import helpers
+import geometry
 
 
 class TurtleCallbacks:
     """Controller for a turtle, use with commands"""
     MINIMUM_BRANCH_LENGTH = 5
+    RANDOM_CHUNK = 10000  # Lines per draw call, so the window can redraw while random draws a lot of them
 
-    def __init__(self, pen: turtle.RawTurtle, screen: turtle.TurtleScreen, output: typing.Callable[[str], None], reset_console: typing.Callable[[], None]):
+    def __init__(self, pen: turtle.RawTurtle, screen: turtle.TurtleScreen, output: typing.Callable[[str], None], reset_console: typing.Callable[[], None],
+                 wait: typing.Callable[[float], None] = time.sleep, settings: Settings = None):
         """Initialize callbacks
 
         :param pen: Turtle object to control
         :param screen: Screen object to control
         :param output: Callable for output
         :param reset_console: Callable to reset console
+        :param wait: Callable that waits for some seconds, see CommandWorker.wait for one that can be cancelled
+        :param settings: User settings, without them fractals are computed in this process only
         """
         self.pen = pen
         self.screen = screen
         self.output = output
         self.reset_console = reset_console
+        self.wait = wait
+        self.settings = settings
 
     def penup(self):
         self.pen.penup()
@@ -60,56 +72,49 @@ class TurtleCallbacks:
         self.pen.left(angle)
 
     def sleep(self, seconds: float):
-        time.sleep(seconds)
+        deadline = time.monotonic() + seconds
+        self.sync()  # Show everything drawn so far, even in a batch
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self.wait(remaining)
 
     def delay(self, millis: int):
         self.screen.delay(millis)
 
-    def random(self, number: int):
-        original_color = self.pen.color()[0]
-        for _ in range(number):
-            self.pen.color(random_color())
-            x = random.randint(0, self.screen.canvwidth) - (self.screen.canvwidth/2)
-            y = random.randint(0, self.screen.canvheight) - (self.screen.canvheight/2)
-            self.pen.goto(x, y)
-        self.pen.color(original_color)
+    def random(self, number: int, seed: int = None):
+        rng = random.Random(seed)
+        # Every random number needed, x, y and color for each line, in one call
+        words = array("I")
+        words.frombytes(rng.getrandbits(32 * 3 * number).to_bytes(4 * 3 * number, "little"))
+        if sys.byteorder == "big":
+            words.byteswap()
+        canvwidth = self.screen.canvwidth
+        canvheight = self.screen.canvheight
+        points = [tuple(self.pen.pos())]
+        points.extend(((x * (canvwidth + 1) >> 32) - canvwidth / 2, (y * (canvheight + 1) >> 32) - canvheight / 2)
+                      for x, y in zip(words[0::3], words[1::3]))
+        was_down = self.pen.isdown()
+        if was_down:
+            width = self.pen.width()
+            colors = words[2::3]
+            for start in range(0, number, self.RANDOM_CHUNK):
+                chunk_colors = ["#%06x" % (color & 0xFFFFFF) for color in colors[start:start + self.RANDOM_CHUNK]]
+                self.screen.draw_segments(points[start:start + self.RANDOM_CHUNK + 1], chunk_colors, width)
+        # End up at the last point, like drawing the lines with the turtle would
+        self.pen.penup()
+        self.pen.goto(*points[-1])
+        if was_down:
+            self.pen.pendown()
 
     def polygon(self, side_length: float, sides: int):
-        start_pos = self.pen.pos()
-        start_heading = self.pen.heading()
-        sum_of_interior = (sides - 2) * 180
-        interior_angle = sum_of_interior / sides
-        self.pen.setheading(90 + (180 / sides) + start_heading)
-        self.pen.penup()
-        radius = side_length / (2 * math.sin(math.pi / sides))  # Center
-        self.pen.forward(radius)
-        self.pen.pendown()
-        self.pen.setheading(0 + start_heading)
-        for _ in range(sides):
-            self.pen.forward(side_length)
-            self.pen.right(180 - interior_angle)
-        # Reset
-        self.pen.penup()
-        self.pen.goto(*start_pos)
-        self.pen.setheading(start_heading)
-        self.pen.pendown()
+        points = geometry.regular_polygon(self.pen.pos(), self.pen.heading(), side_length, sides)
+        self.screen.draw_polyline(points, self.pen.pencolor(), self.pen.width())
+        self.pen.pendown()  # Drawing it with the turtle left the pen down
 
     def circle(self, radius: float):
-        start_pos = self.pen.pos()
-        start_heading = self.pen.heading()
-        # Position
-        self.pen.setheading(270)
-        self.pen.penup()
-        self.pen.forward(radius)
-        # Draw
-        self.pen.pendown()
-        self.pen.setheading(0)
-        self.pen.circle(radius)
-        # Reset
-        self.pen.penup()
-        self.pen.goto(*start_pos)
-        self.pen.setheading(start_heading)
-        self.pen.pendown()
+        points = geometry.circle(self.pen.pos(), radius)
+        self.screen.draw_polyline(points, self.pen.pencolor(), self.pen.width())
+        self.pen.pendown()  # Drawing it with the turtle left the pen down
 
     def shape(self, shape: str):
         self.pen.shape(shape)
@@ -141,57 +146,203 @@ class TurtleCallbacks:
     def clear(self):
         self.reset_console()
 
+    # View
+    def show_view(self, view: typing.Tuple[float, float, float]):
+        x, y, zoom = view
+        self.output(f"Viewing ({x:.2f}, {y:.2f}) at {zoom:g}x zoom")
+
+    def pan(self, x: int, y: int):
+        self.show_view(self.screen.pan_view(x, y))
+
+    def zoom(self, factor: float):
+        if factor <= 0:
+            raise ValueError("Zoom factor must be more than 0")
+        self.show_view(self.screen.zoom_view(factor))
+
+    def reset_view(self):
+        self.show_view(self.screen.reset_view())
+
+    def export(self, name: str, scale: float = 1.0):
+        """Draw the view into an image file, without the window
+
+        :param name: File name in the user's exports, ending in .png (the default) or .ppm
+        :param scale: Image pixels per pixel on screen
+        :return: None
+        """
+        if scale <= 0:
+            raise ValueError("Export scale must be more than 0")
+        import raster  # Only needed here, not worth importing at startup
+        base, extension = os.path.splitext(os.path.basename(name))  # Always in exports, like saves
+        if base == "":
+            raise ValueError(f"Can't export to {name}, give the image a name")
+        extension = extension.lower() or ".png"
+        write = raster.FORMATS.get(extension)
+        if write is None:
+            raise ValueError(f"Can't export {extension} files, use one of {', '.join(raster.FORMATS)}")
+        area, zoom = self.screen.view_area()
+        width = max(round((area[2] - area[0]) * zoom * scale), 1)
+        height = max(round((area[3] - area[1]) * zoom * scale), 1)
+        def rgb(color: str) -> bytes:  # Called once per color
+            if color.startswith("#"):  # Parsed here, asking the screen would be a round trip to the main thread
+                return raster.parse_color(color)
+            return self.screen.color_rgb(color)  # Tk may know names raster doesn't, like SystemButtonFace
+
+        background = rgb(self.screen.bgcolor())
+        lines = self.screen.drawn_lines()
+        path = os.path.abspath(helpers.external_path(os.path.join("exports", base + extension)))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            # Line widths are in screen pixels at any zoom, like on the canvas
+            write(file, width, height, raster.rasterize(lines, area, width, height, background, rgb, scale))
+        self.output(f"Exported {width}x{height} image to {path}")
+
+    def sync(self):
+        """Wait for the screen to catch up with everything drawn so far
+
+        When the pen and screen are worker.MainThreadProxy objects, this raises any error from a drawing call
+        that didn't wait for its result.
+        """
+        self.screen.update()
+
+    def check(self):
+        """Raise any error from a drawing call that didn't wait for its result, without redrawing the screen
+
+        Lets a batch tell which of its commands failed while still only updating the screen once, at its end.
+        """
+        self.screen.tracer()  # Waits through a worker.MainThreadProxy, drawing nothing
+
+    @contextlib.contextmanager
+    def rendering(self, mode: str):
+        """Show drawing according to a rendering mode until the end of the block
+
+        Inside a batch (or with animation turned off) this does nothing, the batch updates once when it ends.
+
+        :param mode: animate, batch, or a number of segments between screen updates, see settings.render_tracer
+        """
+        tracer = render_tracer(mode)
+        orig_tracer = self.screen.tracer()
+        if tracer is None or orig_tracer == 0 or tracer == orig_tracer:
+            yield
+            return
+        self.screen.tracer(tracer)
+        try:
+            yield
+        except BaseException:
+            self._restore_tracer(orig_tracer)  # What the block raised matters more than what interrupted this
+            raise
+        interrupted = self._restore_tracer(orig_tracer)
+        if interrupted is not None:
+            raise interrupted
+
+    def _restore_tracer(self, tracer: int) -> typing.Optional[BaseException]:
+        """Set the tracer back after rendering, even if the command is cancelled again while doing so
+
+        Left at 0, every later command would draw without updating the screen. Through a worker.MainThreadProxy
+        a cancel, or the error from a call that didn't wait, is only raised once, so trying again gets through.
+
+        :param tracer: Tracer to go back to
+        :return: What interrupted setting it, if anything
+        """
+        interrupted = None
+        failed = False
+        while True:
+            try:
+                self.screen.tracer(tracer)  # Also redraws the screen
+                return interrupted
+            except Exception as e:  # noqa
+                if failed:  # Setting the tracer itself fails
+                    raise
+                failed = True
+                interrupted = interrupted if interrupted is not None else e
+            except BaseException as e:  # noqa, CommandCancelled, Esc pressed again
+                interrupted = interrupted if interrupted is not None else e
+
+    def batch(self) -> typing.ContextManager:
+        """Hold back screen updates until the end of the block
+
+        Nested batches only update once, when the outermost one ends.
+        """
+        return self.rendering("batch")
+
+    # Checkpoints
+    def snapshot_size(self) -> int:
+        """Rough number of bytes snapshot would take, without taking it"""
+        return self.screen.snapshot_size()
+
+    def snapshot(self, index: int) -> Checkpoint:
+        """Capture the drawing and turtle state
+
+        :param index: Number of history commands that have run
+        :return: Checkpoint
+        """
+        return Checkpoint(index, self.screen.snapshot_items(), pen_state(self.pen, self.screen))
+
+    def restore(self, checkpoint: Checkpoint):
+        """Return drawing and turtle to the state captured in checkpoint
+
+        :param checkpoint: Checkpoint from snapshot
+        :return: None
+        """
+        orig_tracer = self.screen.tracer()
+        self.screen.tracer(0)
+        self.screen.reset()
+        self.screen.restore_items(checkpoint.items)
+        apply_pen_state(self.pen, self.screen, checkpoint.pen_state)
+        self.screen.end_command(checkpoint.index)
+        self.screen.tracer(orig_tracer)
+
+    def end_command(self, index: int):
+        """Mark what has been drawn since the last call as drawn by the first index history commands
+
+        :param index: Number of history commands that have run
+        :return: None
+        """
+        self.screen.end_command(index)
+
+    def rewind(self, index: int) -> bool:
+        """Remove what was drawn after index commands and return the turtle to its state at that point
+
+        :param index: Number of history commands to go back to
+        :return: Whether the screen still knew that state, if not nothing changed and history has to be replayed
+        """
+        state = self.screen.rewind(index)
+        if state is None:
+            return False
+        apply_pen_state(self.pen, self.screen, state)
+        return True
+
     # Fractals
+    def workers(self) -> int:
+        """Processes to compute big fractals with, see parallel.worker_count"""
+        return 1 if self.settings is None else self.settings["workers"]
+
     def tree_fractal(self, branch_length, shorten_by, angle):
-        orig_delay = self.screen.delay()
-        self.screen.delay(0)
-        if branch_length > self.MINIMUM_BRANCH_LENGTH:
-            self.pen.forward(branch_length)
-            new_length = branch_length - shorten_by
-            self.pen.left(angle)
-            self.tree_fractal(new_length, shorten_by, angle)
-            self.pen.right(angle * 2)
-            self.tree_fractal(new_length, shorten_by, angle)
-            self.pen.left(angle)
-            self.pen.backward(branch_length)
-        self.screen.delay(orig_delay)
-
-    def koch_line(self, branch_length: float, scale: float):  # shorten by 1/3 every time
-        if branch_length > 3:
-            # ___
-            self.koch_line(branch_length / 3, scale)
-            self.pen.left(60)  # /
-            self.koch_line(branch_length / 3, scale)
-            self.pen.right(120)  # \
-            self.koch_line(branch_length / 3, scale)
-            self.pen.left(60)  # ___
-            self.koch_line(branch_length / 3, scale)
-        else:
-            self.pen.forward(branch_length*scale)
-
-    def _koch_snowflake(self, branch_length: float, sides: int, scale: float):
-        start_pos = self.pen.pos()
-        start_heading = self.pen.heading()
-        sum_of_interior = (sides - 2) * 180
-        interior_angle = sum_of_interior / sides
-        self.pen.setheading(90 + (180 / sides) + start_heading)
-        self.pen.penup()
-        radius = (branch_length * scale) / (2 * math.sin(math.pi / sides))  # Center
-        self.pen.forward(radius)
-        self.pen.pendown()
-        self.pen.setheading(0 + start_heading)
-        for _ in range(sides):
-            # t.forward(branch_length)
-            self.koch_line(branch_length, scale)
-            self.pen.right(180 - interior_angle)
-        # Reset
-        self.pen.penup()
-        self.pen.goto(*start_pos)
-        self.pen.setheading(start_heading)
-        self.pen.pendown()
+        if not self.pen.isdown():  # Turtle would end up where it started, with nothing drawn
+            return
+        import parallel  # Only needed for fractals, not worth importing at startup
+        points = parallel.tree_fractal(self.pen.pos(), self.pen.heading(), branch_length, shorten_by, angle,
+                                       self.MINIMUM_BRANCH_LENGTH, workers=self.workers())
+        self.screen.draw_polyline(points, self.pen.pencolor(), self.pen.width())
 
     def koch_snowflake(self, sides: int, depth: int, scale: float = 1.0):
-        orig_delay = self.screen.delay()
-        self.screen.delay(0)
-        self._koch_snowflake(3**depth, sides, scale)
-        self.screen.delay(orig_delay)
+        import parallel  # Only needed for fractals, not worth importing at startup
+        points = parallel.koch_snowflake(self.pen.pos(), self.pen.heading(), 3**depth, sides, scale, self.workers())
+        self.screen.draw_polyline(points, self.pen.pencolor(), self.pen.width())
+        self.pen.pendown()  # Drawing it with the turtle left the pen down
+
+    def lsystems(self):
+        import lsystem  # Only needed for L-systems, not worth importing at startup
+        self.output(f"Available L-systems: {list(lsystem.PRESETS)}")
+
+    def lsystem(self, name: str, depth: int, length: float = 5.0):
+        import lsystem  # Only needed for L-systems, not worth importing at startup
+        try:
+            system = lsystem.PRESETS[name]
+        except KeyError:
+            raise ValueError(f"No L-system named {name}, try one of {list(lsystem.PRESETS)}")
+        if not self.pen.isdown():
+            return
+        color = self.pen.pencolor()
+        width = self.pen.width()
+        for points in system.polylines(self.pen.pos(), self.pen.heading(), length, depth):
+            self.screen.draw_polyline(points, color, width)
@@ -0,0 +1,134 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+__all__ = ["Checkpoint", "CheckpointKeeper", "estimate_size", "pen_state", "apply_pen_state"]
+
+import typing
+import sys
+
+
+def pen_state(pen, screen) -> typing.Dict[str, typing.Any]:
+    """Capture the turtle state that commands can change
+
+    :param pen: Turtle
+    :param screen: Screen it draws on
+    :return: State for apply_pen_state
+    """
+    return {
+        "pos": tuple(pen.pos()),
+        "heading": pen.heading(),
+        "pen": pen.pen(),
+        "shape": pen.shape(),
+        "bgcolor": screen.bgcolor(),
+        "delay": screen.delay()
+    }
+
+
+def apply_pen_state(pen, screen, state: typing.Dict[str, typing.Any]):
+    """Return the turtle to a state from pen_state, without drawing"""
+    pen.penup()
+    pen.goto(*state["pos"])
+    pen.setheading(state["heading"])
+    pen.pen(**state["pen"])
+    pen.shape(state["shape"])
+    screen.bgcolor(state["bgcolor"])
+    screen.delay(state["delay"])
+
+
+def estimate_size(items: int, points: int, options: int = 3) -> int:
+    """Rough number of bytes a checkpoint of canvas items holding points x, y pairs in total takes"""
+    return items * (64 + 16 * options) + 16 * points
+
+
+class Checkpoint:
+    """Drawing and turtle state as it was after a certain number of commands"""
+
+    def __init__(self, index: int, items: typing.List, pen_state: typing.Dict[str, typing.Any]):
+        """Initialize a checkpoint
+
+        :param index: Number of history commands that had run when this was taken
+        :param items: Canvas items, as given by CanvasScreen.snapshot_items
+        :param pen_state: Turtle state, as given by TurtleCallbacks.snapshot
+        """
+        self.index = index
+        self.items = items
+        self.pen_state = pen_state
+        self.size = self._estimate_size()
+
+    def _estimate_size(self) -> int:
+        """Rough number of bytes held by this checkpoint"""
+        size = sys.getsizeof(self.items)
+        for kind, coords, options in self.items:
+            size += estimate_size(1, len(coords) // 2, len(options))
+        return size
+
+
+class CheckpointKeeper:
+    """Keeps periodic checkpoints so undo only has to replay the last few commands"""
+
+    def __init__(self, interval: int = 25, budget: int = 16 * 1024 * 1024):
+        """Initialize an empty CheckpointKeeper
+
+        :param interval: How many commands to run between checkpoints
+        :param budget: Maximum bytes to spend on checkpoints, oldest ones get evicted first
+        """
+        self.interval = interval
+        self.budget = budget
+        self.checkpoints: typing.Dict[int, Checkpoint] = {}  # index -> checkpoint, in ascending index order
+        self.size = 0
+
+    def reset(self):
+        self.checkpoints.clear()
+        self.size = 0
+
+    def wants(self, index: int) -> bool:
+        """Whether a checkpoint should be taken after index commands"""
+        return index > 0 and index % self.interval == 0 and index not in self.checkpoints
+
+    def fits(self, size: int) -> bool:
+        """Whether a checkpoint of about size bytes can be kept, see estimate_size"""
+        return size <= self.budget
+
+    def add(self, checkpoint: Checkpoint):
+        if checkpoint.size > self.budget:  # Would just evict everything, including itself
+            return
+        self.discard(checkpoint.index)
+        self.checkpoints[checkpoint.index] = checkpoint
+        self.size += checkpoint.size
+        while self.size > self.budget:
+            self.discard(next(iter(self.checkpoints)))
+
+    def discard(self, index: int):
+        checkpoint = self.checkpoints.pop(index, None)
+        if checkpoint is not None:
+            self.size -= checkpoint.size
+
+    def discard_after(self, index: int):
+        """Forget checkpoints taken after index commands, they no longer match history"""
+        for key in [key for key in self.checkpoints if key > index]:
+            self.discard(key)
+
+    def nearest(self, index: int) -> typing.Optional[Checkpoint]:
+        """Find the latest checkpoint at or before index
+
+        :param index: Number of commands that should have run
+        :return: Checkpoint, or None if undo has to start from scratch
+        """
+        best = None
+        for key, checkpoint in self.checkpoints.items():
+            if key <= index and (best is None or key > best.index):
+                best = checkpoint
+        return best
@@ -14,22 +14,35 @@ Copyright (C) 2022  Sam Wagenaar
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-__all__ = ["InvalidCommandError", "Command", "CommandSet"]
+__all__ = ["InvalidCommandError", "CommandCancelled", "Command", "CommandSet"]
 __version__ = "1.0"
 __author__ = "Sam Wagenaar"
 
 import typing
+import functools
 import os
 from ordered_set import OrderedSet
 from colorama import Fore, Style
 import helpers
 from callbacks import TurtleCallbacks
+from checkpoints import Checkpoint, CheckpointKeeper
+from settings import Settings, render_tracer
+from history_log import HistoryLog
+import save_format
 
 
 class InvalidCommandError(AttributeError):
     pass
 
 
+class CommandCancelled(BaseException):
+    """Raised inside a running command when the user cancels it
+
+    Like KeyboardInterrupt, it isn't an Exception, so it gets past the handlers for commands that fail.
+    """
+    pass
+
+
 # Helpers
 def arg_names(fun) -> typing.List[str]:
     return fun.__code__.co_varnames[:fun.__code__.co_argcount]
@@ -47,12 +60,57 @@ def get_command_name(string: str):
     return string.split(" ")[0]
 
 
+def without_render_prefix(string: str) -> str:
+    """Command with any render mode given before it removed, see CommandSet._render_prefix"""
+    while CommandSet._render_prefix(string) is not None:
+        string = string.split(" ", 2)[2]
+    return string
+
+
+def _split_save_name(name: str) -> typing.Tuple[str, typing.Optional[str]]:
+    """Split a save name into its base name and supported extension, if one was given"""
+    base, _, extension = os.path.basename(name).partition(".")
+    extension = "." + extension.split(".")[-1]
+    return base, extension if extension in save_format.EXTENSIONS else None
+
+
+def save_path(name: str) -> str:
+    """Path to save to, binary unless name ends in .txt
+
+    :param name: Name of save
+    :return: Absolute path in the user's saves
+    """
+    base, extension = _split_save_name(name)
+    file_name = base + (extension or save_format.BINARY_EXTENSION)
+    return os.path.abspath(helpers.external_path(os.path.join("saves", file_name)))
+
+
+def find_save(name: str) -> str:
+    """Find a save file, looking in the user's saves before the builtin ones
+
+    Without a .tsb or .txt extension, whichever of the two was saved last is used.
+
+    :param name: Name of save
+    :return: Absolute path (of the user's save if it doesn't exist anywhere)
+    """
+    base, extension = _split_save_name(name)
+    extensions = save_format.EXTENSIONS if extension is None else [extension]
+    for folder in [helpers.external_path("saves"), helpers.resource_path(os.path.join("assets", "builtin_saves"))]:
+        found = [os.path.join(folder, base + extension) for extension in extensions
+                 if os.path.exists(os.path.join(folder, base + extension))]
+        if len(found) > 0:
+            return os.path.abspath(max(found, key=os.path.getmtime))
+    # Make sure the error is with the normal path if it fails to locate
+    return save_path(name)
+
+
 arg_col = Fore.BLUE
 
 
 class HistoryKeeper:
     def __init__(self):
-        self.history = []
+        self.history = HistoryLog()
+        self.ignored = {"undo", "help"}  # Commands that don't affect the drawing
 
     def reset(self):
         self.history.clear()
@@ -61,46 +119,56 @@ class HistoryKeeper:
         if len(self.history) > 0:
             return self.history.pop(-1)
 
-    def add(self, command: str):
-        if command == "reset" or get_command_name(command) == "load":
+    def add(self, command: str) -> bool:
+        """Record command in history
+
+        :param command: User input
+        :return: Whether the command was appended
+        """
+        bare = without_render_prefix(command)
+        if bare == "reset":
             self.reset()
-        elif command != "undo" and get_command_name(command) != "help":
+        elif get_command_name(bare) == "load":  # Replaces history once the file has been read, see load
+            pass
+        elif get_command_name(bare) not in self.ignored:
             self.history.append(command)
+            return True
+        return False
 
-    def save(self, name: str):
+    def save(self, name: str, frame: save_format.Frame = None):
         """Saves history to file
 
-        :param name: File to save to
+        :param name: File to save to, ending in .txt for plain text
+        :param frame: Drawing made by the history, only kept in binary saves
         :return: None
         """
-        name = os.path.basename(name).split(".")[0]+".txt"
-        file_path = helpers.external_path(os.path.join("saves", name))
-        out = ""
-        for command in self.history:
-            out += command + "\n"
-        f = open(file_path, "w")
-        f.write(out)
-        f.close()
-
-    def load(self, name: str):
+        file_path = save_path(name)
+        if file_path.endswith(save_format.TEXT_EXTENSION):  # The log is already a text save
+            with open(file_path, "wb") as file:
+                self.history.copy_to(file)
+        else:
+            save_format.write_commands(file_path, self.history, frame)
+
+    def load(self, name: str) -> typing.Optional[save_format.Frame]:
         """Loads history from file
 
         :param name: File to load from
-        :return: None
+        :return: Drawing saved with the history, if any
         """
-        name = os.path.basename(name).split(".")[0]+".txt"
-        file_path = helpers.external_path(os.path.join("saves", name))
-        if not os.path.exists(file_path):
-            file_path = helpers.resource_path(os.path.join("assets", "builtin_saves", name))
-        if not os.path.exists(file_path):  # Make sure the error is with the normal path if it fails to locate
-            file_path = helpers.external_path(os.path.join("saves", name))
-        file_path = os.path.abspath(file_path)
-        contents = open(file_path).read().split("\n")
-        # Don't reset until after file confirmed exists
-        self.reset()
-        for command in contents:
-            if command != "" and command != "quit" and command != "exit":
-                self.add(command)
+        frame, commands = save_format.read_save(find_save(name))
+        # Commands are read as they are added, keep the old history until the whole file has been read
+        previous = self.history
+        self.history = HistoryLog()
+        try:
+            for command in commands:
+                if command != "" and command != "quit" and command != "exit":
+                    self.add(command)
+        except BaseException:
+            self.history.close()
+            self.history = previous
+            raise
+        previous.close()
+        return frame
 
 
 # End Helpers
@@ -137,6 +205,24 @@ class Command:
             raise InvalidCommandError("Each argument needs a type")
         self.show_help = True  # True by default, require command set to modify if applicable
 
+    def parse(self, arguments: typing.Sequence[str]) -> typing.List:
+        """Convert argument strings to this command's types
+
+        :param arguments: Arguments given by the user, without the command name
+        :return: Typed arguments
+        """
+        if len(arguments) != self.num_args:
+            raise InvalidCommandError(f"Wrong number of arguments, got {len(arguments)}, expected {self.num_args}")
+        return [kind(argument) for kind, argument in zip(self.types, arguments)]
+
+    def invoke(self, args: typing.Sequence) -> typing.Any:
+        """Call the callback with already converted arguments
+
+        :param args: Arguments from parse
+        :return: Any
+        """
+        return self.callback(*self.callback_args, *args)
+
     def execute(self, string: str) -> typing.Any:
         """Execute the command based on user input.
 
@@ -146,13 +232,7 @@ class Command:
         parts = string.split(" ")
         if parts[0] != self.name:
             raise InvalidCommandError(f"Called execute on command {self.name}, should call on {parts[0]}")
-        parts = parts[1:]
-        if len(parts) != self.num_args:
-            raise InvalidCommandError(f"Wrong number of arguments, got {len(parts)}, expected {self.num_args}")
-        args = []
-        for i in range(self.num_args):
-            args.append(self.types[i](parts[i]))
-        return self.callback(*self.callback_args, *args)
+        return self.invoke(self.parse(parts[1:]))
 
 
 class CommandSet:
@@ -162,49 +242,188 @@ class CommandSet:
     However, this can be used to create sub-commands.
     """
 
-    def __init__(self, output: typing.Callable[[str], None], callbacks: TurtleCallbacks):
-        """Initialize an empty CommandSet"""
+    def __init__(self, output: typing.Callable[[str], None], callbacks: TurtleCallbacks, settings: Settings = None):
+        """Initialize an empty CommandSet
+
+        :param output: Callable for output
+        :param callbacks: Turtle controller, used for undo, save and load
+        :param settings: User settings, loaded from disk if not given
+        """
         self.commands = {}
+        self._routes = None  # Built on first execute, see _build_dispatch
+        self._dispatch = None
         self.register(Command("help", "Display help for all commands", 0, [], self.help))
         self.register(Command("help", "Display help for specified ```command```", 1, [str], self.help))
         self.help_break()
 
-        self.register(Command("save", "Save current drawing to ```file```", 1, [str], self.save))
+        self.register(Command("save", "Save current drawing to ```file``` (plain text if it ends in .txt)", 1, [str], self.save))
         self.register(Command("load", "Load drawing from ```file```", 1, [str], self.load))
+        self.register(Command("run", "Run every command in ```file``` as one batch", 1, [str], self.run_file))
         self.help_break()
 
         self.register(Command("undo", "Undo previous command (does not work on reset)", 0, [], self.undo))
+        self.register(Command("render", "Show how commands draw", 0, [], self.show_render))
+        self.register(Command("render", "Set how commands draw, ```mode``` is animate, batch (all at once), or a number of "
+                              "segments between screen updates. Put render ```mode``` before a command to use it "
+                              "for just that command", 1, [str], self.set_render))
         self.output = output
         self.callbacks = callbacks
+        self.settings = settings if settings is not None else Settings()
         self.history_keeper = HistoryKeeper()
+        self.history_keeper.ignored.add("run")  # The commands it runs are recorded instead
+        self.history_keeper.ignored.add("render")  # Doesn't change the drawing, commands it prefixes are recorded
+        self.checkpoints = CheckpointKeeper()
 
-    def run_history(self, show_out: bool = False):
-        for command in self.history_keeper.history:
-            try:
-                if show_out:
-                    self.output(f"{Fore.LIGHTBLACK_EX}>>{Fore.LIGHTWHITE_EX} {command}{Style.RESET_ALL}")
-                self._execute(command)
-            except Exception as e:  # noqa
-                problem = f"Something went wrong while loading command [{command}]:\n\t"
-                problem += helpers.error_string(e)
-                self.output(helpers.error_format(problem))
+    def run_history(self, show_out: bool = False, start: int = 0, truncate_on_cancel: bool = False):
+        """Replay history
+
+        :param show_out: Echo each command to output
+        :param start: Index of first command to replay, earlier ones must already be drawn
+        :param truncate_on_cancel: If cancelled, remove the commands that weren't replayed from history, so
+            redrawing afterwards doesn't replay them
+        :return: None
+        """
+        history = self.history_keeper.history
+        index = start
+        try:
+            for index in range(start, len(history)):
+                command = history[index]
+                try:
+                    if show_out:
+                        self.output(f"{Fore.LIGHTBLACK_EX}>>{Fore.LIGHTWHITE_EX} {command}{Style.RESET_ALL}")
+                    self._execute(command)
+                    self.callbacks.check()  # Raise errors from calls that didn't wait here, with this command
+                except Exception as e:  # noqa
+                    problem = f"Something went wrong while loading command [{command}]:\n\t"
+                    problem += helpers.error_string(e)
+                    self.output(helpers.error_format(problem))
+                self.callbacks.end_command(index + 1)
+                self.checkpoint(index + 1)
+        except CommandCancelled:
+            if truncate_on_cancel:
+                history.truncate(index)
+            raise
+
+    def checkpoint(self, index: int):
+        """Take a checkpoint if one is due after index commands"""
+        # Copying a drawing too big to keep would only stall the command
+        if self.checkpoints.wants(index) and self.checkpoints.fits(self.callbacks.snapshot_size()):
+            self.checkpoints.add(self.callbacks.snapshot(index))
+
+    def redraw(self):
+        """Make the drawing match history again
+
+        Removes what was drawn after the last command in history if the screen can, otherwise replays from the
+        nearest checkpoint.
+        """
+        index = len(self.history_keeper.history)
+        self.checkpoints.discard_after(index)
+        checkpoint = self.checkpoints.nearest(index)
+        with self.callbacks.batch():
+            if self.callbacks.rewind(index):  # Only the undone commands' drawing has to go
+                return
+            if checkpoint is None:
+                self.callbacks.reset()
+                self.run_history()
+            else:
+                self.callbacks.restore(checkpoint)
+                self.run_history(start=checkpoint.index)
 
     def undo(self):
-        self.callbacks.reset()
         name = self.history_keeper.remove_last() or "NONE"
-        self.run_history()
+        self.redraw()
         self.output(f"Undid one command: {name}")
 
     def load(self, file: str):
-        self.history_keeper.load(file)
+        frame = self.history_keeper.load(file)
         # Don't reset or clear until after load confirmed successful
+        self.checkpoints.reset()
         self.callbacks.clear()
-        self.callbacks.reset()
-        self.run_history(True)
+        if frame is not None:  # Saved with its drawing, no need to replay
+            items, pen_state = frame
+            checkpoint = Checkpoint(len(self.history_keeper.history), items, pen_state)
+            self.callbacks.restore(checkpoint)
+            self.checkpoints.add(checkpoint)
+            self.output(f"Loaded {len(items)} drawn items and {checkpoint.index} commands from {file}")
+            return
+        with self.callbacks.batch():
+            self.callbacks.reset()
+            self.run_history(True, truncate_on_cancel=True)  # Cancelling keeps what has been loaded so far
+
+    def compile(self, script: str) -> typing.List[typing.Tuple[int, str, typing.Callable, typing.List]]:
+        """Check every line of a script against this command set before anything runs
+
+        Blank lines and lines starting with # are skipped.
+
+        :param script: Commands, one per line
+        :return: List of (line number, command, callback, arguments)
+        """
+        compiled = []
+        problems = []
+        for number, line in enumerate(script.split("\n"), 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                call, args = self._resolve(line)
+            except Exception as e:  # noqa
+                problems.append(f"line {number} [{line}]: {helpers.error_string(e)}")
+                continue
+            if call is not None:
+                compiled.append((number, line, call, args))
+        if len(problems) > 0:
+            raise InvalidCommandError("Script has errors, nothing was run:\n\t" + "\n\t".join(problems))
+        return compiled
+
+    def run_script(self, script: str):
+        """Validate and then run a multi-line script with drawing updates held until the end
+
+        Stops at the first command that fails or is cancelled, earlier commands stay in history.
+
+        :param script: Commands, one per line
+        :return: None
+        """
+        compiled = self.compile(script)
+        with self.callbacks.batch():
+            for number, line, call, args in compiled:
+                recorded = self.history_keeper.add(line)
+                try:
+                    call(*args)
+                    self.callbacks.check()  # Raise errors from calls that didn't wait here, with this line
+                except Exception as e:  # noqa
+                    if recorded:
+                        self.history_keeper.remove_last()
+                    raise InvalidCommandError(f"Script stopped at line {number} [{line}]: {helpers.error_string(e)}")
+                except CommandCancelled:
+                    if recorded:
+                        self.history_keeper.remove_last()
+                    self.redraw()  # Remove whatever the cancelled command had drawn
+                    self.output(f"Cancelled, script stopped at line {number} [{line}]")
+                    return
+                self.callbacks.end_command(len(self.history_keeper.history))
+                self.checkpoint(len(self.history_keeper.history))
+
+    def run_file(self, file: str):
+        self.run_script("\n".join(save_format.read_commands(find_save(file))))
+
+    def show_render(self):
+        self.output(f"Rendering mode: {self.settings['render']}")
+
+    def set_render(self, mode: str):
+        self.settings.set("render", mode)
+        self.show_render()
+
+    def _render_call(self, mode: str, call: typing.Callable, *args) -> typing.Any:
+        with self.callbacks.rendering(mode):
+            return call(*args)
 
     def save(self, file: str):
         self.history_keeper.remove_last()  # Don't save this command
-        self.history_keeper.save(file)
+        frame = None
+        if self.settings["save_frames"]:
+            checkpoint = self.callbacks.snapshot(len(self.history_keeper.history))
+            frame = (checkpoint.items, checkpoint.pen_state)
+        self.history_keeper.save(file, frame)
 
     def help(self, command: str = None):
         if command is None:
@@ -259,6 +478,7 @@ class CommandSet:
         registry.add(command)
         self.commands[command.name] = registry
         command.show_help = show_help
+        self._dispatch = None
 
     def alias(self, original: str, aliased: str):
         """Create an alias for commands
@@ -268,6 +488,7 @@ class CommandSet:
         :return: None
         """
         self.commands[aliased] = ("ALIAS", original)
+        self._dispatch = None
 
     def help_break(self):
         """Create a newline in the help message
@@ -275,56 +496,108 @@ class CommandSet:
         :return: None
         """
         self.commands[helpers.uuid()] = ("BREAK",)
+        self._dispatch = None
 
     def execute(self, string: str) -> typing.Any:
         """Wrapper around self._execute to handle exceptions"""
+        recorded = False
         try:
-            self.history_keeper.add(string)
-            self._execute(string)
+            recorded = self.history_keeper.add(string)
+            if self._render_prefix(string) is None:
+                with self.callbacks.rendering(self.settings["render"]):
+                    self._execute(string)
+            else:  # _resolve applies the command's own mode
+                self._execute(string)
+            self.callbacks.sync()
         except Exception as e:  # noqa
-            self.history_keeper.remove_last()  # Something went wrong, don't put in history
+            if recorded:
+                self.history_keeper.remove_last()  # Something went wrong, don't put in history
             problem = "Something went wrong while executing that command:\n\t"
             problem += helpers.error_string(e)
             self.output(helpers.error_format(problem))
+        except CommandCancelled:
+            if recorded:
+                self.history_keeper.remove_last()
+            self.redraw()  # Remove whatever the cancelled command had drawn
+            self.output(f"Cancelled: {string}")
+        else:
+            self.callbacks.end_command(len(self.history_keeper.history))
+            self.checkpoint(len(self.history_keeper.history))
+        finally:
+            self.checkpoints.discard_after(len(self.history_keeper.history))  # reset, load, etc. may shrink history
+
+    def _build_dispatch(self):
+        """Index commands by (name, number of arguments), with aliases resolved ahead of time"""
+        self._routes = {}  # typed name -> real name, or None for help breaks
+        self._dispatch = {}  # (real name, number of arguments) -> (types, bound callback), in registration order
+        for name, value in self.commands.items():
+            resolved = name
+            while type(value) == tuple:  # `while` in case of chained aliasing
+                if value[0] == "ALIAS":
+                    resolved = value[1]
+                    value = self.commands.get(resolved, OrderedSet())  # Missing, reported when it's used
+                elif value[0] == "BREAK":
+                    resolved = None
+                    break
+                else:
+                    raise InvalidCommandError(f"Broken registration for command {name}")
+            self._routes[name] = resolved
+            if resolved == name:
+                for command in value:
+                    call = command.callback
+                    if len(command.callback_args) > 0:
+                        call = functools.partial(call, *command.callback_args)
+                    self._dispatch.setdefault((name, command.num_args), []).append((command.types, call))
 
-    def _execute(self, string: str) -> typing.Any:
-        """Executes given command string.
+    def _resolve(self, string: str) -> typing.Tuple[typing.Optional[typing.Callable], typing.List]:
+        """Find the callback and typed arguments for a command string.
 
-        Uses name of command, number of arguments, and types of arguments to find correct command to execute.
+        Uses name of command, number of arguments, and types of arguments to find correct command.
 
         :param string: User input
-        :return: Any
+        :return: (callback, arguments), callback is None for strings that do nothing
         """
-        original_string = string
+        if self._dispatch is None:
+            self._build_dispatch()
+        mode = self._render_prefix(string)
+        if mode is not None:
+            render_tracer(mode)  # Check it before anything runs
+            call, args = self._resolve(string.split(" ", 2)[2])
+            if call is None:
+                return None, []
+            return functools.partial(self._render_call, mode, call), args
         parts = string.split(" ")
-        name = parts[0]
-        possibilities = self.commands.get(name, set())
-        while type(possibilities) == tuple:  # `while` in case of chained aliasing
-            if possibilities[0] == "ALIAS":
-                name = possibilities[1]
-                possibilities = self.commands.get(name, set())
-                string = name
-                if len(parts) > 1:
-                    string += " " + " ".join(parts[1:])
-            elif possibilities[0] == "BREAK":
-                return
-            else:
-                raise InvalidCommandError(f"Broken registration for command {name}, user input {string}")
-        if len(possibilities) == 0:
+        if parts[0] not in self._routes:
+            raise InvalidCommandError(f"Command {parts[0]} not found")
+        name = self._routes[parts[0]]
+        if name is None:
+            return None, []
+
+        arguments = parts[1:]
+        for types, call in self._dispatch.get((name, len(arguments)), ()):
+            try:
+                args = [kind(argument) for kind, argument in zip(types, arguments)]
+            except TypeError:
+                continue
+            return call, args
+        if name not in self.commands:
             raise InvalidCommandError(f"Command {name} not found")
+        raise InvalidCommandError(f"Command not found with parameters matching: {string}")
 
-        command = None
-        for com in possibilities:
-            if len(parts) - 1 == com.num_args:
-                try:
-                    args = []
-                    for i in range(com.num_args):
-                        args.append(com.types[i](parts[i + 1]))
-                    command = com
-                    break
-                except TypeError:
-                    pass
-        if command is not None:
-            return command.execute(string)
-        else:
-            raise InvalidCommandError(f"Command not found with parameters matching: {original_string}")
+    @staticmethod
+    def _render_prefix(string: str) -> typing.Optional[str]:
+        """Rendering mode given before a command, as in render batch random 1000"""
+        parts = string.split(" ", 2)
+        if len(parts) == 3 and parts[0] == "render":
+            return parts[1]
+        return None
+
+    def _execute(self, string: str) -> typing.Any:
+        """Executes given command string.
+
+        :param string: User input
+        :return: Any
+        """
+        call, args = self._resolve(string)
+        if call is not None:
+            return call(*args)
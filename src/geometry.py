@@ -0,0 +1,283 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Shape geometry computed up front, so it can be drawn in a few canvas calls instead of one per turtle move.
+
+Angles are in degrees and follow turtle's standard mode: heading 0 is east, positive turns are to the left.
+"""
+__all__ = ["unit_polygon", "regular_polygon", "circle_steps", "unit_circle", "circle", "koch_level", "koch_turns",
+           "koch_line", "koch_snowflake", "tree_fractal_levels", "tree_fractal", "tree_fractal_split", "merge_close_points"]
+
+import typing
+import math
+import functools
+from array import array
+from itertools import accumulate
+
+Point = typing.Tuple[float, float]
+
+
+@functools.lru_cache(maxsize=128)
+def unit_polygon(sides: int) -> typing.Tuple[Point, ...]:
+    """Corners of a regular polygon with a circumradius of 1, in the order polygon draws them at heading 0
+
+    :param sides: Number of sides
+    :return: sides + 1 points, the last is the first again
+    """
+    if sides < 1:
+        raise ValueError("A polygon needs at least one side")
+    first = 90 + 180 / sides
+    return tuple((math.cos(math.radians(first - 360 * k / sides)), math.sin(math.radians(first - 360 * k / sides)))
+                 for k in range(sides + 1))
+
+
+def regular_polygon(center: Point, heading: float, side_length: float, sides: int) -> typing.List[Point]:
+    """Corners of a regular polygon around center, as the turtle draws them
+
+    :param center: Center of the polygon
+    :param heading: Turtle heading, the first side is drawn in this direction
+    :param side_length: Length of each side
+    :param sides: Number of sides
+    :return: Closed list of points
+    """
+    radius = side_length / (2 * math.sin(math.pi / sides))
+    cos = radius * math.cos(math.radians(heading))
+    sin = radius * math.sin(math.radians(heading))
+    x, y = center
+    return [(x + ux * cos - uy * sin, y + ux * sin + uy * cos) for ux, uy in unit_polygon(sides)]
+
+
+def circle_steps(radius: float) -> int:
+    """Number of straight pieces turtle.RawTurtle.circle uses for a full circle"""
+    return 1 + int(min(11 + abs(radius) / 6.0, 59.0))
+
+
+@functools.lru_cache(maxsize=128)
+def unit_circle(steps: int) -> typing.Tuple[Point, ...]:
+    """Points around a circle of radius 1, counterclockwise from the bottom
+
+    :param steps: Number of straight pieces
+    :return: steps + 1 points, the last is the first again
+    """
+    return tuple((math.cos(math.radians(270 + 360 * k / steps)), math.sin(math.radians(270 + 360 * k / steps)))
+                 for k in range(steps + 1))
+
+
+def circle(center: Point, radius: float, steps: int = None) -> typing.List[Point]:
+    """Points of a circle around center, as turtle.RawTurtle.circle approximates it
+
+    :param center: Center of the circle
+    :param radius: Radius
+    :param steps: Number of straight pieces, chosen from radius like turtle does by default
+    :return: Closed list of points, starting from the bottom of the circle
+    """
+    if steps is None:
+        steps = circle_steps(radius)
+    x, y = center
+    return [(x + radius * ux, y + radius * uy) for ux, uy in unit_circle(steps)]
+
+
+def koch_level(branch_length: float) -> typing.Tuple[int, float]:
+    """How many times a koch line of branch_length is divided, and the length of the pieces
+
+    Lines are divided into thirds until they are at most 3 long.
+
+    :param branch_length: Length of the whole line
+    :return: (level, piece length)
+    """
+    level = 0
+    while branch_length > 3:
+        branch_length /= 3
+        level += 1
+    return level, branch_length
+
+
+def koch_turns(level: int) -> typing.List[int]:
+    """Turns between the pieces of a koch line, in sixths of a full turn
+
+    Expanded iteratively, each level replaces every piece with the four pieces of _/\\_
+
+    :param level: Number of divisions
+    :return: 4**level - 1 turns
+    """
+    turns = []
+    for _ in range(level):
+        turns = turns + [1] + turns + [-2] + turns + [1] + turns
+    return turns
+
+
+def koch_line(start: complex, heading: float, piece_length: float, level: int) -> typing.List[complex]:
+    """Points of one koch line, as drawn by the turtle
+
+    :param start: Where the line starts
+    :param heading: Direction of the whole line
+    :param piece_length: Length of each of the 4**level pieces
+    :param level: Number of divisions
+    :return: Points after start, the last one is the end of the line
+    """
+    # Only six directions are possible along a line, look them up instead of doing trig per piece
+    directions = [piece_length * complex(math.cos(math.radians(heading + 60 * k)),
+                                         math.sin(math.radians(heading + 60 * k))) for k in range(6)]
+    steps = [directions[k % 6] for k in accumulate(koch_turns(level), initial=0)]
+    return list(accumulate(steps, initial=start))[1:]
+
+
+def koch_snowflake(start: Point, heading: float, branch_length: float, sides: int, scale: float = 1.0,
+                   line: typing.Callable[[complex, float, float, int], typing.List[complex]] = koch_line
+                   ) -> typing.List[Point]:
+    """Points of a koch snowflake centered on start, as drawn by the turtle
+
+    :param start: Center of the snowflake
+    :param heading: Turtle heading, the first side is drawn in this direction
+    :param branch_length: Unscaled length of each side
+    :param sides: Number of sides
+    :param scale: Scale of the whole snowflake
+    :param line: Computes each side, with the arguments of koch_line
+    :return: Closed list of points
+    """
+    sum_of_interior = (sides - 2) * 180
+    interior_angle = sum_of_interior / sides
+    radius = (branch_length * scale) / (2 * math.sin(math.pi / sides))  # Center
+    corner_angle = math.radians(90 + (180 / sides) + heading)
+    point = complex(start[0] + radius * math.cos(corner_angle), start[1] + radius * math.sin(corner_angle))
+
+    level, piece_length = koch_level(branch_length)
+    piece_length *= scale
+    points = [point]
+    side_heading = heading
+    for _ in range(sides):
+        points.extend(line(point, side_heading, piece_length, level))
+        point = points[-1]
+        side_heading -= 180 - interior_angle
+    return [(p.real, p.imag) for p in points]
+
+
+def tree_fractal_levels(branch_length: float, shorten_by: float, minimum_length: float = 5) -> int:
+    """How many levels of branches a tree fractal has
+
+    :param branch_length: Length of the trunk
+    :param shorten_by: How much shorter each level of branches is
+    :param minimum_length: Branches this short or shorter are not drawn
+    :return: Number of levels, a tree has 2**levels - 1 branches
+    """
+    if branch_length <= minimum_length:
+        return 0
+    if shorten_by <= 0:
+        raise ValueError("shorten_by must be positive, the tree would never end")
+    return math.ceil((branch_length - minimum_length) / shorten_by)
+
+
+def tree_fractal(start: Point, heading: float, branch_length: float, shorten_by: float, angle: float,
+                 minimum_length: float = 5, maximum_branches: int = 2**22) -> typing.List[Point]:
+    """Path the turtle takes drawing a tree fractal, out along every branch and back again
+
+    Uses an explicit stack, so deep trees don't hit the recursion limit.
+
+    :param start: Base of the trunk
+    :param heading: Direction of the trunk
+    :param branch_length: Length of the trunk
+    :param shorten_by: How much shorter each level of branches is
+    :param angle: Angle between a branch and its parent
+    :param minimum_length: Branches this short or shorter are not drawn
+    :param maximum_branches: Refuse to generate trees bigger than this
+    :return: List of points, starting and ending at start
+    """
+    levels = tree_fractal_levels(branch_length, shorten_by, minimum_length)
+    if 2**levels - 1 > maximum_branches:
+        raise ValueError(f"Tree would have 2**{levels} - 1 branches, the limit is {maximum_branches}")
+
+    points = [tuple(start)]
+    stack = [(start[0], start[1], heading, branch_length)]  # branches to draw, or points to step back to
+    while len(stack) > 0:
+        branch = stack.pop()
+        if len(branch) == 2:  # Walk back down to the base of a finished branch
+            points.append(branch)
+            continue
+        x, y, branch_heading, length = branch
+        if length <= minimum_length:
+            continue
+        radians = math.radians(branch_heading)
+        end = (x + length * math.cos(radians), y + length * math.sin(radians))
+        points.append(end)
+        stack.append((x, y))
+        stack.append((end[0], end[1], branch_heading - angle, length - shorten_by))  # Right, drawn second
+        stack.append((end[0], end[1], branch_heading + angle, length - shorten_by))  # Left, drawn first
+    return points
+
+
+def tree_fractal_split(start: Point, heading: float, branch_length: float, shorten_by: float, angle: float,
+                       levels: int, minimum_length: float = 5) -> typing.List[typing.Tuple[float, ...]]:
+    """Path of the first levels of a tree fractal, with the branches above them left to be filled in
+
+    Each branch left out is an (x, y, heading, length) tuple, where tree_fractal of it gives the missing
+    points (after its first).
+
+    :param start: Base of the trunk
+    :param heading: Direction of the trunk
+    :param branch_length: Length of the trunk
+    :param shorten_by: How much shorter each level of branches is
+    :param angle: Angle between a branch and its parent
+    :param levels: Levels of branches to include
+    :param minimum_length: Branches this short or shorter are not drawn
+    :return: List of (x, y) points and (x, y, heading, length) branches, in drawing order
+    """
+    points = [tuple(start)]
+    stack = [(start[0], start[1], heading, branch_length, 0)]
+    while len(stack) > 0:
+        branch = stack.pop()
+        if len(branch) == 2:
+            points.append(branch)
+            continue
+        x, y, branch_heading, length, level = branch
+        if length <= minimum_length:
+            continue
+        if level == levels:
+            points.append(branch[:4])
+            continue
+        radians = math.radians(branch_heading)
+        end = (x + length * math.cos(radians), y + length * math.sin(radians))
+        points.append(end)
+        stack.append((x, y))
+        stack.append((end[0], end[1], branch_heading - angle, length - shorten_by, level + 1))
+        stack.append((end[0], end[1], branch_heading + angle, length - shorten_by, level + 1))
+    return points
+
+
+def merge_close_points(points: typing.Sequence[float], distance: float) -> array:
+    """Drop points closer than distance to the last point kept, like pixels merge points when zoomed out
+
+    :param points: Flat x, y coordinates
+    :param distance: Points closer than this to the previous kept point are dropped
+    :return: Flat x, y coordinates, the first and last points are always kept
+    """
+    if len(points) <= 4:
+        return array("d", points)
+    distance_squared = distance * distance
+    last_x = points[0]
+    last_y = points[1]
+    merged = array("d", (last_x, last_y))
+    for i in range(2, len(points) - 2, 2):
+        x = points[i]
+        y = points[i + 1]
+        if (x - last_x) ** 2 + (y - last_y) ** 2 >= distance_squared:
+            merged.append(x)
+            merged.append(y)
+            last_x = x
+            last_y = y
+    merged.append(points[-2])
+    merged.append(points[-1])
+    return merged
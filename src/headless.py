@@ -0,0 +1,380 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Pen and screen backends that draw into memory instead of a Tk canvas.
+
+TurtleCallbacks only needs a pen with the turtle.RawTurtle methods it calls and a screen with the
+CanvasScreen methods it calls, so HeadlessPen and HeadlessScreen can be passed anywhere a
+RawTurtle and CanvasScreen are expected, no display required.
+"""
+__all__ = ["HeadlessScreen", "HeadlessPen"]
+
+import typing
+import math
+from array import array
+from turtle import Vec2D
+from checkpoints import pen_state, estimate_size
+from scene import CommandStates, MIN_ZOOM, MAX_ZOOM
+import raster
+
+
+class HeadlessScreen:
+    """Records what is drawn as line segments in flat arrays"""
+    SHAPES = ["arrow", "blank", "circle", "classic", "square", "triangle", "turtle"]
+
+    def __init__(self, canvwidth: int = 600, canvheight: int = 600):
+        """Initialize an empty screen
+
+        :param canvwidth: Width of the drawing area
+        :param canvheight: Height of the drawing area
+        """
+        self.canvwidth = canvwidth
+        self.canvheight = canvheight
+        self._turtles = []
+        self._delayvalue = 10
+        self._tracing = 1
+        self._bgcolor = "white"
+        self.segments = array("d")  # x0, y0, x1, y1 for every segment, in turtle coordinates
+        self.segment_colors = array("I")  # index into palette, one per segment
+        self.segment_widths = array("f")  # one per segment
+        self.palette = []
+        self._palette_index = {}
+        self.other_items = []  # Restored canvas items that aren't lines, kept for the next snapshot
+        self.states = CommandStates()  # index -> (segment count, other item count, turtle state)
+        self.view_center = (0.0, 0.0)
+        self.zoom = 1.0
+
+    # Recording
+    def _color_index(self, color: str) -> int:
+        index = self._palette_index.get(color)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(color)
+            self._palette_index[color] = index
+        return index
+
+    def add_segment(self, x0: float, y0: float, x1: float, y1: float, color: str, width: float):
+        self.segments.extend((x0, y0, x1, y1))
+        self.segment_colors.append(self._color_index(color))
+        self.segment_widths.append(width)
+
+    def draw_polyline(self, points: typing.Sequence[typing.Tuple[float, float]], color: str, width: float):
+        """Record connected line segments, see CanvasScreen.draw_polyline"""
+        count = len(points) - 1
+        if count < 1:
+            return
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            self.segments.extend((x0, y0, x1, y1))
+        self.segment_colors.extend(array("I", [self._color_index(color)]) * count)
+        self.segment_widths.extend(array("f", [width]) * count)
+
+    def draw_segments(self, points: typing.Sequence[typing.Tuple[float, float]], colors: typing.Sequence[str],
+                      width: float):
+        """Record connected line segments, each in its own color, see CanvasScreen.draw_segments"""
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            self.segments.extend((x0, y0, x1, y1))
+        self.segment_colors.extend(array("I", [self._color_index(color) for color in colors]))
+        self.segment_widths.extend(array("f", [width]) * (len(points) - 1))
+
+    def segment_count(self) -> int:
+        return len(self.segment_colors)
+
+    def clear(self):
+        """Forget everything drawn"""
+        self.segments = array("d")
+        self.segment_colors = array("I")
+        self.segment_widths = array("f")
+        self.palette = []
+        self._palette_index = {}
+        self.other_items = []
+        self.states.clear()
+
+    def end_command(self, index: int):
+        """Remember how much was drawn after index commands, see CanvasScreen.end_command"""
+        state = pen_state(self._turtles[0], self) if len(self._turtles) > 0 else None
+        self.states.add(index, (self.segment_count(), len(self.other_items), state))
+
+    def rewind(self, index: int) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Forget what was drawn after index commands, see CanvasScreen.rewind"""
+        entry = self.states.get(index)
+        if entry is None or entry[2] is None:
+            return None
+        segments, others, state = entry
+        del self.segments[4 * segments:]
+        del self.segment_colors[segments:]
+        del self.segment_widths[segments:]
+        del self.other_items[others:]
+        self.states.discard_after(index)
+        return state
+
+    # View, kept for pan and zoom, nothing is culled or simplified here
+    def look_at(self, x: float, y: float, zoom: float) -> typing.Tuple[float, float, float]:
+        """Center the view on x, y at zoom, see CanvasScreen.look_at"""
+        self.view_center = (x, y)
+        self.zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        return x, y, self.zoom
+
+    def pan_view(self, dx: float, dy: float) -> typing.Tuple[float, float, float]:
+        x, y = self.view_center
+        return self.look_at(x + dx / self.zoom, y + dy / self.zoom, self.zoom)
+
+    def zoom_view(self, factor: float) -> typing.Tuple[float, float, float]:
+        return self.look_at(*self.view_center, self.zoom * factor)
+
+    def reset_view(self) -> typing.Tuple[float, float, float]:
+        return self.look_at(0.0, 0.0, 1.0)
+
+    def view_area(self) -> typing.Tuple[typing.Tuple[float, float, float, float], float]:
+        """Turtle coordinates the view covers, and its zoom, see CanvasScreen.view_area"""
+        x, y = self.view_center
+        half_width = self.canvwidth / 2 / self.zoom
+        half_height = self.canvheight / 2 / self.zoom
+        return (x - half_width, y - half_height, x + half_width, y + half_height), self.zoom
+
+    # Export
+    def drawn_lines(self) -> typing.List[typing.Tuple[array, typing.Union[str, typing.List[str]], float]]:
+        """Connected segments of the same width as polylines, see CanvasScreen.drawn_lines"""
+        lines = []
+        segments = self.segments
+        points = None
+        colors = []
+        width = None
+        for i in range(self.segment_count()):
+            x0, y0, x1, y1 = segments[4 * i:4 * i + 4]
+            if points is None or self.segment_widths[i] != width or (points[-2], points[-1]) != (x0, y0):
+                if points is not None:
+                    lines.append(self._drawn_line(points, colors, width))
+                points = array("d", (x0, y0))
+                colors = []
+                width = self.segment_widths[i]
+            points.extend((x1, y1))
+            colors.append(self.palette[self.segment_colors[i]])
+        if points is not None:
+            lines.append(self._drawn_line(points, colors, width))
+        return lines
+
+    @staticmethod
+    def _drawn_line(points: array, colors: typing.List[str],
+                    width: float) -> typing.Tuple[array, typing.Union[str, typing.List[str]], float]:
+        return points, colors[0] if colors.count(colors[0]) == len(colors) else colors, width
+
+    @staticmethod
+    def color_rgb(color: str) -> bytes:
+        """Color as 3 bytes of RGB, see CanvasScreen.color_rgb"""
+        return raster.parse_color(color)
+
+    # TurtleScreen
+    def turtles(self) -> typing.List["HeadlessPen"]:
+        return self._turtles
+
+    def delay(self, delay: int = None):
+        if delay is None:
+            return self._delayvalue
+        self._delayvalue = int(delay)
+
+    def tracer(self, n: int = None, delay: int = None):
+        if n is None:
+            return self._tracing
+        self._tracing = int(n)
+        if delay is not None:
+            self._delayvalue = int(delay)
+
+    def update(self):
+        pass
+
+    def bgcolor(self, *args):
+        if len(args) == 0:
+            return self._bgcolor
+        self._bgcolor = args[0]
+
+    def getshapes(self) -> typing.List[str]:
+        return list(self.SHAPES)
+
+    def reset(self):
+        self.clear()
+        for pen in self._turtles:
+            pen.reset()
+
+    # CanvasScreen
+    def snapshot_size(self) -> int:
+        """Bytes snapshot_items would copy at most, as if no segments were merged, see CanvasScreen.snapshot_size"""
+        segments = self.segment_count()
+        return estimate_size(segments + len(self.other_items),
+                             2 * segments + sum(len(coords) // 2 for _, coords, _ in self.other_items))
+
+    def snapshot_items(self) -> typing.List:
+        """Drawing as canvas items (y flipped, like Tk), see CanvasScreen.snapshot_items
+
+        Connected segments of the same color and width are merged into one line item.
+        """
+        items = []
+        segments = self.segments
+        coords = []
+        style = None
+        for i in range(self.segment_count()):
+            x0, y0, x1, y1 = segments[4 * i:4 * i + 4]
+            segment_style = (self.segment_colors[i], self.segment_widths[i])
+            if segment_style != style or coords[-2:] != [x0, -y0]:
+                if len(coords) > 0:
+                    items.append(("line", tuple(coords), self._line_options(style)))
+                coords = [x0, -y0]
+                style = segment_style
+            coords.append(x1)
+            coords.append(-y1)
+        if len(coords) > 0:
+            items.append(("line", tuple(coords), self._line_options(style)))
+        return items + self.other_items
+
+    def _line_options(self, style: typing.Tuple[int, float]) -> typing.Tuple[typing.Tuple[str, str], ...]:
+        return ("fill", self.palette[style[0]]), ("width", str(style[1]))
+
+    def restore_items(self, items: typing.Iterable):
+        """Replace the drawing with canvas items, see CanvasScreen.restore_items"""
+        self.clear()
+        for kind, coords, options in items:
+            if kind != "line":
+                self.other_items.append((kind, coords, options))
+                continue
+            options = dict(options)
+            color = options.get("fill", "black")
+            width = float(options.get("width", 1.0))
+            for i in range(0, len(coords) - 2, 2):
+                self.add_segment(coords[i], -coords[i + 1], coords[i + 2], -coords[i + 3], color, width)
+
+
+class HeadlessPen:
+    """Turtle that moves and draws on a HeadlessScreen"""
+
+    def __init__(self, screen: HeadlessScreen):
+        self.screen = screen
+        screen.turtles().append(self)
+        self.reset()
+
+    def reset(self):
+        self._x = 0.0
+        self._y = 0.0
+        self._heading = 0.0
+        self._shape = "classic"
+        self._pen = {
+            "shown": True,
+            "pendown": True,
+            "pencolor": "black",
+            "fillcolor": "black",
+            "pensize": 1,
+            "speed": 3,
+            "resizemode": "noresize",
+            "stretchfactor": (1.0, 1.0),
+            "outline": 1,
+            "tilt": 0.0
+        }
+
+    def _goto(self, x: float, y: float):
+        if self._pen["pendown"]:
+            self.screen.add_segment(self._x, self._y, x, y, self._pen["pencolor"], self._pen["pensize"])
+        self._x = x
+        self._y = y
+
+    # Movement
+    def forward(self, distance: float):
+        angle = math.radians(self._heading)
+        self._goto(self._x + distance * math.cos(angle), self._y + distance * math.sin(angle))
+
+    def back(self, distance: float):
+        self.forward(-distance)
+
+    backward = back
+
+    def left(self, angle: float):
+        self._heading = (self._heading + angle) % 360.0
+
+    def right(self, angle: float):
+        self.left(-angle)
+
+    def setheading(self, angle: float):
+        self._heading = angle % 360.0
+
+    def heading(self) -> float:
+        return self._heading
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        self._goto(float(x), float(y))
+
+    def pos(self) -> Vec2D:
+        return Vec2D(self._x, self._y)
+
+    position = pos
+
+    def circle(self, radius: float, extent: float = None, steps: int = None):
+        """Same polygon approximation as turtle.RawTurtle.circle"""
+        if extent is None:
+            extent = 360.0
+        if steps is None:
+            steps = 1 + int(min(11 + abs(radius) / 6.0, 59.0) * abs(extent) / 360.0)
+        w = extent / steps
+        w2 = 0.5 * w
+        length = 2.0 * radius * math.sin(math.radians(w2))
+        if radius < 0:
+            length, w, w2 = -length, -w, -w2
+        self.left(w2)
+        for _ in range(steps):
+            self.forward(length)
+            self.left(w)
+        self.left(-w2)
+
+    # Pen
+    def penup(self):
+        self._pen["pendown"] = False
+
+    def pendown(self):
+        self._pen["pendown"] = True
+
+    def isdown(self) -> bool:
+        return self._pen["pendown"]
+
+    def color(self, *args):
+        if len(args) == 0:
+            return self._pen["pencolor"], self._pen["fillcolor"]
+        self._pen["pencolor"] = args[0]
+        self._pen["fillcolor"] = args[-1]
+
+    def pencolor(self, color: str = None):
+        if color is None:
+            return self._pen["pencolor"]
+        self._pen["pencolor"] = color
+
+    def width(self, width: float = None):
+        if width is None:
+            return self._pen["pensize"]
+        self._pen["pensize"] = width
+
+    pensize = width
+
+    def shape(self, name: str = None):
+        if name is None:
+            return self._shape
+        if name not in self.screen.getshapes():
+            raise ValueError(f"There is no shape named {name}")
+        self._shape = name
+
+    def pen(self, pen: typing.Dict = None, **pendict):
+        if pen is None and len(pendict) == 0:
+            return dict(self._pen)
+        if pen is not None:
+            self._pen.update(pen)
+        self._pen.update(pendict)
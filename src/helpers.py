@@ -22,19 +22,21 @@ __all__ = ["error_format",
            "uuid",
            "license_notice",
            "ansi_to_hex",
-           "has_accepted_license",
+           "parse_ansi",
+           "license_text",
            "external_path",
            "LicenseConfirmationPopup",
            "rr"]
 
 from tkinter import Misc
 import tkinter as tk
-from colorama import Fore, Back
+from colorama import Fore, Back, Style
 from tkinter.simpledialog import Dialog
-import webbrowser
 import random
+import typing
 import os
 import sys
+import re
 
 LICENSE_VERSION = "1"  # Change this if license changes, will require user to re-accept license
 
@@ -87,6 +89,52 @@ def ansi_to_hex(ansi):
             raise AttributeError("Invalid color")
 
 
+ansi_pattern = re.compile("\x1b[^\x1bm]*m")
+default_fore = ansi_fore_to_hex[Fore.WHITE]
+# sequence -> (format, foreground, background), None means leave unchanged, "" means reset
+ansi_effects = {
+    Style.NORMAL: ("normal", None, None),
+    Style.BRIGHT: ("bold", None, None),
+    Style.DIM: ("italic", None, None),
+    Style.RESET_ALL: ("normal", default_fore, ""),
+    Fore.RESET: (None, default_fore, None),
+    Back.RESET: (None, None, "")
+}
+ansi_effects.update({ansi: (None, color, None) for ansi, color in ansi_fore_to_hex.items()})
+ansi_effects.update({ansi: (None, None, color) for ansi, color in ansi_back_to_hex.items()})
+
+
+def parse_ansi(string: str) -> typing.List[typing.Tuple[str, str, str, typing.Optional[str]]]:
+    """Split text into runs of identical formatting
+
+    Understands colorama.Fore.*, colorama.Back.* and colorama.Style.* (Dim is handled as italic)
+
+    :param string: Text containing ANSI escape sequences
+    :return: List of (text, format, foreground, background) where format is normal, bold, or italic
+    """
+    segments = []
+    fmt = "normal"
+    fore_color = default_fore
+    back_color = None
+    position = 0
+    for match in ansi_pattern.finditer(string):
+        if match.start() > position:
+            segments.append((string[position:match.start()], fmt, fore_color, back_color))
+        position = match.end()
+        try:
+            new_fmt, new_fore, new_back = ansi_effects[match.group()]
+        except KeyError:
+            print("Invalid ansi sequence received: " + match.group().replace("\x1b", "\\x1b"))
+            continue
+        fmt = new_fmt or fmt
+        fore_color = new_fore or fore_color
+        if new_back is not None:
+            back_color = new_back or None
+    if position < len(string):
+        segments.append((string[position:], fmt, fore_color, back_color))
+    return segments
+
+
 def rgb_to_hex(rgb):
     return '#%02x%02x%02x' % rgb
 
@@ -139,21 +187,6 @@ def uuid() -> str:
     return out
 
 
-def has_accepted_license() -> bool:
-    """Check whether user has accepted our license"""
-    try:
-        with open(external_path(".license_accepted.txt")) as file:
-            return file.read().split("\n")[0] == LICENSE_VERSION
-    except FileNotFoundError:
-        return False
-
-
-def set_accepted_license():
-    """Record that the user has accepted the latest license"""
-    with open(external_path(".license_accepted.txt"), "w") as file:
-        file.write(LICENSE_VERSION)
-
-
 def license_notice() -> str:
     return """
 Copyright (C) 2022  Sam Wagenaar
@@ -177,8 +210,19 @@ def get_full_license() -> str:
     return "Copyright (C) 2022  Sam Wagenaar\n\n\n" + open(resource_path("assets/CODE_LICENSE.txt")).read()
 
 
+def license_text() -> typing.Tuple[str, int]:
+    """Full license and the length of its longest line, for the license dialog
+
+    :return: (text, width)
+    """
+    text = get_full_license()
+    return text, max(len(line) for line in text.split("\n"))
+
+
 class LicenseConfirmationPopup(Dialog):
-    def __init__(self, parent: Misc | None, get_font):
+    def __init__(self, parent: Misc | None, get_font, text: str, width: int):
+        self.full_text = text
+        self.text_width = width
         self.bottom_text = None
         self.license_scrollbar = None
         self.license_text = None
@@ -189,10 +233,8 @@ class LicenseConfirmationPopup(Dialog):
 
     def body(self, master) -> None:
         self.scrollable_license_frame = tk.Frame(master)
-        text = get_full_license()
-        width = 0
-        for line in text.split("\n"):
-            width = max(width, len(line))
+        text = self.full_text
+        width = self.text_width
         self.license_text = tk.Text(self.scrollable_license_frame,
                                     height=20,
                                     width=width,
@@ -251,4 +293,5 @@ class LicenseConfirmationPopup(Dialog):
 
 
 def rr():
+    import webbrowser  # Only needed here, not worth importing at startup
     webbrowser.open("https://www.youtube.com/watch?v=dQw4w9WgXcQ", -1, True)
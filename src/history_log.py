@@ -0,0 +1,157 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Command history kept on disk instead of in memory.
+
+The log is an append-only temporary file with one utf-8 command per line, the same layout as a .txt save.
+Only the offset of each line is kept in memory (8 bytes per command), lines are read back through mmap.
+"""
+__all__ = ["HistoryLog"]
+
+import typing
+import mmap
+import tempfile
+from array import array
+
+COPY_CHUNK = 1024 * 1024
+
+
+class HistoryLog:
+    """List of commands backed by a memory-mapped file
+
+    Supports what history needs from a list: len, indexing, slicing, iteration, append, pop, truncate and clear.
+    """
+
+    def __init__(self, commands: typing.Iterable[str] = ()):
+        """Initialize a log in a new temporary file, deleted when closed
+
+        :param commands: Commands to start with
+        """
+        self._file = tempfile.TemporaryFile(prefix="turtleshell_history_")
+        self._offsets = array("Q")  # Start of each line in the file
+        self._end = 0  # End of the last line, anything after it has been popped
+        self._map = None
+        self._mapped = 0  # Bytes of the file that _map is known to cover
+        self._unflushed = False
+        self._at_end = True  # Whether the file position is at _end
+        for command in commands:
+            self.append(command)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: typing.Union[int, slice]) -> typing.Union[str, typing.List[str]]:
+        if isinstance(index, slice):
+            return [self._line(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self._line(index)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for i in range(len(self)):
+            yield self._line(i)
+
+    def __repr__(self) -> str:
+        return f"<HistoryLog of {len(self)} commands>"
+
+    def _line_end(self, index: int) -> int:
+        return self._offsets[index + 1] if index + 1 < len(self._offsets) else self._end
+
+    def _line(self, index: int) -> str:
+        end = self._line_end(index)
+        self._ensure_mapped(end)
+        return self._map[self._offsets[index]:end - 1].decode("utf-8")  # Without the newline
+
+    def _ensure_mapped(self, end: int):
+        """Make sure the first end bytes of the log can be read through _map"""
+        if self._unflushed:
+            self._file.flush()
+            self._unflushed = False
+        if end <= self._mapped:
+            return
+        if self._map is not None:
+            self._map.close()
+        # Map the whole file, it grows in place so older offsets stay valid
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = len(self._map)
+
+    def append(self, command: str):
+        if "\n" in command:
+            raise ValueError("Commands in history can't contain newlines")
+        encoded = command.encode("utf-8") + b"\n"
+        if not self._at_end:
+            self._file.seek(self._end)
+            self._at_end = True
+        self._file.write(encoded)
+        self._unflushed = True
+        self._offsets.append(self._end)
+        self._end += len(encoded)
+
+    def extend(self, commands: typing.Iterable[str]):
+        for command in commands:
+            self.append(command)
+
+    def pop(self, index: int = -1) -> str:
+        """Remove and return the last command
+
+        Only the last command can be removed, the log is append-only.
+        """
+        if len(self) == 0:
+            raise IndexError("pop from empty history")
+        if index not in (-1, len(self) - 1):
+            raise IndexError("Only the last command can be popped from history")
+        command = self._line(len(self) - 1)
+        self._end = self._offsets.pop()  # Overwritten by the next append
+        self._at_end = False
+        return command
+
+    def truncate(self, length: int):
+        """Remove every command after the first length"""
+        if length < len(self):
+            self._end = self._offsets[length]  # Overwritten by the next append
+            del self._offsets[length:]
+            self._at_end = False
+
+    def clear(self):
+        self._offsets = array("Q")
+        self._end = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped = 0
+        self._file.truncate(0)
+        self._at_end = False
+
+    def copy_to(self, file: typing.BinaryIO):
+        """Write the log to an open binary file, as the lines of a .txt save"""
+        self._ensure_mapped(self._end)
+        if self._end == 0:
+            return
+        view = memoryview(self._map)
+        try:
+            for start in range(0, self._end, COPY_CHUNK):
+                file.write(view[start:min(start + COPY_CHUNK, self._end)])
+        finally:
+            view.release()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
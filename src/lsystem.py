@@ -0,0 +1,178 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Lindenmayer systems: string rewriting rules, interpreted as turtle moves.
+
+Symbols understood when drawing:
+    any symbol in draw_symbols -- move forward, drawing
+    f -- move forward without drawing
+    + -- turn left by the system's angle
+    - -- turn right by the system's angle
+    [ -- remember position and heading
+    ] -- return to the last remembered position and heading
+Everything else is only used by the rewriting rules.
+"""
+__all__ = ["LSystem", "ExpansionCache", "PRESETS", "expansion_cache"]
+
+import typing
+import math
+from collections import OrderedDict
+
+Point = typing.Tuple[float, float]
+
+
+class ExpansionCache:
+    """Least recently used cache of expanded strings, limited by their total length"""
+
+    def __init__(self, budget: int = 32 * 1024 * 1024):
+        """Initialize an empty cache
+
+        :param budget: Maximum number of characters to keep
+        """
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable) -> typing.Optional[str]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: typing.Hashable, value: str):
+        if len(value) > self.budget:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+expansion_cache = ExpansionCache()
+
+
+class LSystem:
+    """A set of rewriting rules and how to draw the result"""
+    MAXIMUM_LENGTH = 16 * 1024 * 1024  # Refuse expansions longer than this
+
+    def __init__(self, name: str, axiom: str, rules: typing.Dict[str, str], angle: float, draw_symbols: str = "F"):
+        """Initialize an L-system
+
+        :param name: Name used by the lsystem command
+        :param axiom: Starting string
+        :param rules: Symbol -> replacement, symbols without a rule are kept as they are
+        :param angle: Degrees turned by + and -
+        :param draw_symbols: Symbols that draw a line forward
+        """
+        self.name = name
+        self.axiom = axiom
+        self.rules = dict(rules)
+        self.angle = angle
+        self.draw_symbols = draw_symbols
+        self._table = str.maketrans(self.rules)
+        self._key = (axiom, tuple(sorted(self.rules.items())))
+
+    def expand(self, depth: int, cache: ExpansionCache = None) -> str:
+        """Apply the rules depth times
+
+        Starts from the deepest cached expansion at or below depth.
+
+        :param depth: Number of rewriting passes
+        :param cache: Cache of expansions, the shared one by default
+        :return: Expanded string
+        """
+        if depth < 0:
+            raise ValueError("depth can't be negative")
+        if cache is None:
+            cache = expansion_cache
+        string = None
+        level = depth
+        while level > 0:
+            string = cache.get((self._key, level))
+            if string is not None:
+                break
+            level -= 1
+        if string is None:
+            string = self.axiom
+        while level < depth:
+            string = string.translate(self._table)
+            level += 1
+            if len(string) > self.MAXIMUM_LENGTH:
+                raise ValueError(f"{self.name} at depth {depth} is too long to draw")
+            cache.put((self._key, level), string)
+        return string
+
+    def polylines(self, start: Point, heading: float, step: float, depth: int) -> typing.List[typing.List[Point]]:
+        """Interpret the expansion as turtle moves
+
+        :param start: Starting position
+        :param heading: Starting heading
+        :param step: Distance of each forward move
+        :param depth: Number of rewriting passes
+        :return: Connected runs of points, one per unbroken stroke
+        """
+        x, y = start
+        directions = {}  # heading -> (dx, dy), headings repeat a lot
+        stack = []
+        line = [(x, y)]
+        lines = [line]
+        for symbol in self.expand(depth):
+            if symbol in self.draw_symbols or symbol == "f":
+                direction = directions.get(heading)
+                if direction is None:
+                    radians = math.radians(heading)
+                    direction = directions[heading] = (step * math.cos(radians), step * math.sin(radians))
+                x += direction[0]
+                y += direction[1]
+                if symbol == "f":
+                    line = [(x, y)]
+                    lines.append(line)
+                else:
+                    line.append((x, y))
+            elif symbol == "+":
+                heading = (heading + self.angle) % 360
+            elif symbol == "-":
+                heading = (heading - self.angle) % 360
+            elif symbol == "[":
+                stack.append((x, y, heading))
+            elif symbol == "]":
+                x, y, heading = stack.pop()
+                line = [(x, y)]
+                lines.append(line)
+        return [line for line in lines if len(line) > 1]
+
+
+PRESETS = {system.name: system for system in [
+    LSystem("dragon", "FX", {"X": "X+YF+", "Y": "-FX-Y"}, 90),
+    LSystem("hilbert", "A", {"A": "+BF-AFA-FB+", "B": "-AF+BFB+FA-"}, 90),
+    LSystem("sierpinski", "F-G-G", {"F": "F-G+F+G-F", "G": "GG"}, 120, "FG"),
+    LSystem("gosper", "A", {"A": "A-B--B+A++AA+B-", "B": "+A-BB--B-A++A+B"}, 60, "AB"),
+    LSystem("plant", "X", {"X": "F+[[X]-X]-F[-FX]+X", "F": "FF"}, 25)
+]}
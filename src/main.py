@@ -23,33 +23,55 @@ Class: Intro to Programming
 """
 
 import turtle
+import typing
 import tkinter as tk
-from queue import Queue
+from queue import Queue, Empty
+import threading
 import os
 import sys
 from colorama import Fore, Back, Style
 import time
-from command_lib import Command, CommandSet, InvalidCommandError
+from command_lib import Command, CommandSet, InvalidCommandError, CommandCancelled
 from callbacks import TurtleCallbacks
 from standard_command_set import StandardCommandSet
+from screens import CanvasScreen
+from settings import Settings
+from worker import CommandWorker
 import helpers
 
-tkextrafont_loaded = True
 try:
     from tkextrafont import Font
+    tkextrafont_loaded = True
 except ModuleNotFoundError:
-    tkextrafont_loaded = False
-    import pyglet
     from tkinter.font import Font
+    tkextrafont_loaded = False
 
-    for variant in ["Bold", "BoldItalic", "Italic", "Regular"]:
+FONT_VARIANTS = {  # (bold, italic) -> file variant, family, Font options
+    (False, False): ("Regular", "Fantasque Sans Mono Regular", {}),
+    (True, False): ("Bold", "Fantasque Sans Mono Bold", {"weight": "bold"}),
+    (False, True): ("Italic", "Fantasque Sans Mono Italic", {"slant": "italic"}),
+    (True, True): ("BoldItalic", "Fantasque Sans Mono Bold Italic", {"weight": "bold", "slant": "italic"})
+}
+FONT_SIZE = 13
+STARTUP_FONT = ("TkFixedFont", FONT_SIZE)  # Used until the real fonts are loaded, after the window is shown
+font_files_registered = False
+
+
+def register_font_files():
+    """Make the bundled fonts available through pyglet, only needed without tkextrafont
+
+    pyglet is only imported here, it is slow to import and not needed to show the window.
+    """
+    global font_files_registered
+    if font_files_registered:
+        return
+    font_files_registered = True
+    print("tkextrafont could not be found, using pyglet-based backup")
+    import pyglet
+    for variant, _, _ in FONT_VARIANTS.values():
         pyglet.font.add_file(helpers.resource_path(
             os.path.join("assets", "fonts", "FantasqueSansMono-" + variant + ".ttf")))
 
-print(helpers.license_notice())
-
-if not tkextrafont_loaded:
-    print("tkextrafont could not be found, using pyglet-based backup")
 
 # Ensure dictionary insertion-ordering
 test_dict = {}  # noqa
@@ -71,46 +93,26 @@ def quit_callback():
 # Run GUI #
 ###########
 class App:
+    FRAME_MS = 16  # Console output is written at most once per frame
+
     def __init__(self, master: tk.Tk):
         self.master = master
         self.master.title("Final Project Sam Wagenaar")
+        self.settings = Settings()
+        self.spill_path = helpers.external_path("console_spill.log")
+        self.spilled = False  # Whether this session has written to the spill log yet
+        self.output_queue = Queue()  # (text, end) waiting to be written to the console
+        self.flush_pending = False
 
         self.canvas = tk.Canvas(master)
         self.canvas.config(width=600, height=600)
         self.canvas.pack(side=tk.LEFT)
-        self.screen = turtle.TurtleScreen(self.canvas)
-
-        if tkextrafont_loaded:
-            self.fonts = {"regular": Font(file="assets/fonts/FantasqueSansMono-Regular.ttf",
-                                          family="Fantasque Sans Mono Regular",
-                                          size=13),
-                          "bold": Font(file="assets/fonts/FantasqueSansMono-Bold.ttf",
-                                       family="Fantasque Sans Mono Bold",
-                                       size=13,
-                                       weight="bold"),
-                          "italic": Font(file="assets/fonts/FantasqueSansMono-Italic.ttf",
-                                         family="Fantasque Sans Mono Italic",
-                                         size=13,
-                                         slant="italic"),
-                          "bold_italic": Font(file="assets/fonts/FantasqueSansMono-BoldItalic.ttf",
-                                              family="Fantasque Sans Mono Bold Italic",
-                                              size=13,
-                                              weight="bold",
-                                              slant="italic")}
-        else:
-            self.fonts = {"regular": Font(family="Fantasque Sans Mono Regular",
-                                          size=13),
-                          "bold": Font(family="Fantasque Sans Mono Bold",
-                                       size=13,
-                                       weight="bold"),
-                          "italic": Font(family="Fantasque Sans Mono Italic",
-                                         size=13,
-                                         slant="italic"),
-                          "bold_italic": Font(family="Fantasque Sans Mono Bold Italic",
-                                              size=13,
-                                              weight="bold",
-                                              slant="italic")}
+        self.screen = CanvasScreen(self.canvas)
 
+        self.fonts = {}  # (bold, italic) -> Font, created on first use by get_font
+        self.fonts_ready = False  # Whether widgets and tags use the real fonts yet, see finish_startup
+
+        self.tags = {}  # (widget, fmt, fore, back) -> tag name, one tag per formatting combination
         self.console_frame = tk.Frame(self.master)
         self.console_frame.pack(side=tk.RIGHT, fill=tk.BOTH)
 
@@ -119,7 +121,7 @@ class App:
                                    relief=tk.GROOVE,
                                    background="#2b2b2b",
                                    foreground="#ff00ff",
-                                   font=self.get_font(),
+                                   font=STARTUP_FONT,
                                    state=tk.DISABLED)
         self.console_out.pack(side=tk.TOP, fill=tk.BOTH)
 
@@ -128,7 +130,7 @@ class App:
                                   relief=tk.GROOVE,
                                   background="#2b2b2b",
                                   foreground="#007F00",
-                                  font=self.get_font(italic=True),
+                                  font=STARTUP_FONT,
                                   insertbackground="#007F00")
         self.console_in.bind("<Return>", self.console_input)
         self.console_in.pack(side=tk.TOP, fill=tk.X)
@@ -136,33 +138,86 @@ class App:
 
         self.my_lovely_turtle = turtle.RawTurtle(self.screen)
 
-        self.standardCommandSet = StandardCommandSet(self.my_lovely_turtle,
-                                                     self.screen,
-                                                     self.master.destroy,
-                                                     self.add_to_console,
-                                                     self.clear_console)
+        # Commands run on the worker thread, everything they do with Tk is sent back to this one
+        self.worker = CommandWorker(self.master, self.FRAME_MS)
+        self.standardCommandSet = StandardCommandSet(self.worker.proxy(self.my_lovely_turtle),
+                                                     self.worker.proxy(self.screen),
+                                                     self.worker.on_main(self.master.destroy),
+                                                     self.worker.on_main(self.add_to_console),
+                                                     self.worker.on_main(self.clear_console),
+                                                     self.settings,
+                                                     self.worker.wait)
+        self.master.bind("<Escape>", self.cancel_command)
         self.clear_console()
         os.makedirs(helpers.resource_path("saves"), exist_ok=True)
 
+        # Everything else waits until the window has been drawn once
+        self.console_out.bind("<Map>", self.on_first_map)
+
+    def on_first_map(self, event=None):
+        self.console_out.unbind("<Map>")
+        self.master.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        """Load fonts and check the license, once the window is showing
+
+        :return: None
+        """
+        self.fonts_ready = True
+        self.console_out.configure(font=self.get_font())
+        self.console_in.configure(font=self.get_font(italic=True))
+        for (widget, fmt, _, _), name in self.tags.items():
+            self.master.nametowidget(widget).tag_configure(name, font=self._tag_font(fmt))
         self.confirm_license_acceptance()
 
     def confirm_license_acceptance(self):
-        if not helpers.has_accepted_license():  # We need to accept license
-            dialog = helpers.LicenseConfirmationPopup(self.canvas, self.get_font)
-            if dialog.accepted:
-                helpers.set_accepted_license()
-            else:
-                self.master.destroy()
-
-    def get_font(self, bold: bool = False, italic: bool = False):
-        if bold and italic:
-            return self.fonts["bold_italic"]
-        elif bold:
-            return self.fonts["bold"]
-        elif italic:
-            return self.fonts["italic"]
+        if self.settings.has_accepted_license():
+            return
+        # We need to accept license, read it in the background so the window stays responsive
+        results = Queue()
+
+        def read_license():
+            try:
+                results.put(helpers.license_text())
+            except Exception as e:  # noqa
+                results.put(e)
+        threading.Thread(target=read_license, daemon=True).start()
+        self.show_license_when_read(results)
+
+    def show_license_when_read(self, results: Queue):
+        try:
+            result = results.get_nowait()
+        except Empty:
+            self.master.after(self.FRAME_MS, self.show_license_when_read, results)
+            return
+        if isinstance(result, Exception):  # Asked again next time
+            self.add_to_console(helpers.error_format("Couldn't read the license:\n\t" + helpers.error_string(result)))
+            return
+        text, width = result
+        dialog = helpers.LicenseConfirmationPopup(self.canvas, self.get_font, text, width)
+        if dialog.accepted:
+            self.settings.accept_license()
         else:
-            return self.fonts["regular"]
+            self.master.destroy()
+
+    def get_font(self, bold: bool = False, italic: bool = False) -> Font:
+        """Get a console font, loading it the first time it is needed
+
+        :param bold: Bold variant
+        :param italic: Italic variant
+        :return: Font
+        """
+        key = (bold, italic)
+        font = self.fonts.get(key)
+        if font is None:
+            variant, family, options = FONT_VARIANTS[key]
+            if tkextrafont_loaded:
+                options = dict(options, file=helpers.resource_path(
+                    os.path.join("assets", "fonts", "FantasqueSansMono-" + variant + ".ttf")))
+            else:
+                register_font_files()
+            font = self.fonts[key] = Font(family=family, size=FONT_SIZE, **options)
+        return font
 
     def console_input(self, event):
         if event.widget.cget('state') == tk.NORMAL:
@@ -170,20 +225,37 @@ class App:
             self.add_to_console(f"{Fore.LIGHTBLACK_EX}>>{Fore.LIGHTWHITE_EX} {string}{Style.RESET_ALL}")
             event.widget.delete("1.0", tk.END)
             event.widget.insert("1.0",
-                                "Working...",
+                                "Working... (Esc to cancel)",
                                 self._tag_from_params("normal",
                                                       helpers.ansi_to_hex(Fore.LIGHTYELLOW_EX)[1],
                                                       "None",
                                                       event.widget))
             event.widget.configure(state=tk.DISABLED)
-            try:
-                self.standardCommandSet.user_input(string)
-                event.widget.configure(state=tk.NORMAL)
-                event.widget.after(0, lambda: event.widget.delete("1.0", tk.END))
-            except tk.TclError:  # Quit run, widget no longer exists
-                pass
+            self.worker.submit(lambda: self.standardCommandSet.user_input(string),
+                               lambda error: self.command_finished(event.widget, error))
+
+    def command_finished(self, widget: tk.Text, error: typing.Optional[BaseException]):
+        """Called once a command from console_input has run and drawn everything
+
+        :param widget: Input that was disabled while it ran
+        :param error: Anything the command didn't handle itself
+        :return: None
+        """
+        if isinstance(error, CommandCancelled):
+            self.add_to_console(helpers.error_format("Cancelled"))
+        elif error is not None:
+            self.add_to_console(helpers.error_format(helpers.error_string(error)))
+        try:
+            widget.configure(state=tk.NORMAL)
+            widget.delete("1.0", tk.END)
+        except tk.TclError:  # Quit run, widget no longer exists
+            pass
+
+    def cancel_command(self, event=None):
+        self.worker.cancel()
 
     def clear_console(self):
+        self._drain_output()  # Anything not yet written would have been cleared anyway
         self.console_out.configure(state=tk.NORMAL)  # We need to be able to write
         self.console_out.delete("1.0", tk.END)
         self.console_out.configure(state=tk.DISABLED)  # User else needs to not write
@@ -192,24 +264,33 @@ class App:
         self.add_to_console(f"{Style.BRIGHT}{Fore.YELLOW}Type `help` for help{Style.RESET_ALL}")
 
     def _tag_from_params(self, fmt: str, fore_color: str, back_color: str, widget: tk.Text = None) -> str:
-        """Create a formatting tag from given parameters
+        """Get the formatting tag for given parameters, creating it the first time it is needed
 
         :param fmt: normal, bold, or italic
         :param fore_color: hex color
         :param back_color: hex color
         :return: tag id
         """
-        name = helpers.uuid()
         if widget is None:
             widget = self.console_out
         if back_color == "None":
             back_color = None
-        widget.tag_configure(name,
-                             foreground=fore_color,
-                             background=back_color,
-                             font=self.get_font(bold=(fmt == "bold"), italic=(fmt == "italic")))
+        key = (str(widget), fmt, fore_color, back_color)
+        name = self.tags.get(key)
+        if name is None:
+            name = f"{fmt}{fore_color}{back_color or ''}"
+            widget.tag_configure(name,
+                                 foreground=fore_color,
+                                 background=back_color,
+                                 font=self._tag_font(fmt))
+            self.tags[key] = name
         return name
 
+    def _tag_font(self, fmt: str):
+        if not self.fonts_ready:
+            return STARTUP_FONT
+        return self.get_font(bold=(fmt == "bold"), italic=(fmt == "italic"))
+
     def add_to_console(self, string: str, end: str = "\n"):
         """Add text to console
 
@@ -223,89 +304,70 @@ class App:
 
         NOTE: Style is fully reset at end of text, \r doesn't work
 
+        Text is queued and written on the next frame, so bursts of output only update the widget once.
 
         :param string: Text to add
         :param end: String to put at end of text
         :return: None
         """
-        string += end
-        # Build formatted segments
-        segments = []  # segments of text, split by formatting changes (text, tag)
-        segment = ""  # segment of text currently being built
-        fmt = "normal"  # normal, bold, or italic
-        fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
-        back_color = None
-        building_ansi = False  # If we are currently inside an ansi escape sequence
-        building_text = True  # If we are currently inside of normal text
-        ansi_start = "\x1b"
-        safe_ansi_start = "\\x1b"
-        ansi_end = "m"
-        ansi_in_progress = ""
-        for char in string:
-            if char == ansi_start:  # Ansi start encountered
-                # print(segments)
-                if building_text:  # We were building a segment of text, add it
-                    segments.append((segment, self._tag_from_params(fmt, fore_color, back_color)))
-                    segment = ""
-
-                if building_ansi:
-                    raise ValueError("Ansi start found while building ansi")
-
-                building_ansi = True
-                building_text = False
-                ansi_in_progress = ansi_start
-                # print(f"Ansi start character found, bt: {building_text}, ba: {building_ansi}")
-            elif building_ansi:  # We are in the middle of an ansi escape sequence
-                # print(f"Ansi in progress: {ansi_in_progress.replace(ansi_start, safe_ansi_start)}")
-                ansi_in_progress += char
-                if char == ansi_end:  # Ansi sequence complete
-                    if ansi_in_progress == Style.NORMAL:
-                        fmt = "normal"
-                    elif ansi_in_progress == Style.BRIGHT:
-                        fmt = "bold"
-                    elif ansi_in_progress == Style.DIM:
-                        fmt = "italic"
-                    elif ansi_in_progress == Style.RESET_ALL:
-                        fmt = "normal"
-                        fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
-                        back_color = None
-                    elif ansi_in_progress == Fore.RESET:
-                        fore_color = helpers.ansi_to_hex(Fore.WHITE)[1]
-                    elif ansi_in_progress == Back.RESET:
-                        back_color = None
-                    else:  # Maybe it is a color
-                        try:
-                            kind, color = helpers.ansi_to_hex(ansi_in_progress)
-                            if kind == 0:
-                                fore_color = color
-                            elif kind == 1:
-                                back_color = color
-                            else:
-                                raise ValueError("kind received other than 0 or 1")
-                        except AttributeError:
-                            print("Invalid ansi sequence received: "
-                                  + ansi_in_progress.replace(ansi_start, safe_ansi_start))
-                    ansi_in_progress = ""
-                    building_ansi = False
-            elif (not building_ansi) and (not building_text):  # We're not in an ansi sequence, and were in one before
-                # print("Reached end of escape sequence set")
-                building_text = True
-            if building_text:
-                # print(f"Adding char: {char}")
-                segment += char
-        # Make sure the last bit isn't ignored
-        if building_text:  # We were building a segment of text, add it
-            segments.append((segment, self._tag_from_params(fmt, fore_color, back_color)))
-            segment = ""
+        self.output_queue.put((string, end))
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.master.after(self.FRAME_MS, self.flush_console)
+
+    def _drain_output(self) -> typing.List[typing.Tuple[str, str]]:
+        """Take everything currently waiting in the output queue"""
+        pending = []
+        try:
+            while True:
+                pending.append(self.output_queue.get_nowait())
+        except Empty:
+            return pending
+
+    def flush_console(self):
+        """Write all queued output to the console
+
+        :return: None
+        """
+        self.flush_pending = False
+        # Build formatted segments as alternating text, tag arguments for a single insert
+        segments = []
+        for string, end in self._drain_output():
+            for text, fmt, fore_color, back_color in helpers.parse_ansi(string + end):
+                segments.append(text)
+                segments.append(self._tag_from_params(fmt, fore_color, back_color))
+        if len(segments) == 0:
+            return
 
         # Add formatted segments
         self.console_out.configure(state=tk.NORMAL)  # We need to be able to write
-        for text, tag in segments:
-            self.console_out.insert(tk.END, text, tag)
+        self.console_out.insert(tk.END, *segments)
+        self.trim_console()
         self.console_out.configure(state=tk.DISABLED)  # User else needs to not write
         # Autoscroll
         self.console_out.see("end")
 
+    def trim_console(self):
+        """Drop the oldest console lines once there are too many
+
+        Lines are dropped in chunks of a tenth of the limit, so most writes don't trim at all.
+        Console must be writable.
+
+        :return: None
+        """
+        limit = self.settings["scrollback_lines"]
+        if limit <= 0:
+            return
+        lines = int(self.console_out.index("end-1c").split(".")[0])
+        if lines <= limit + max(limit // 10, 1):
+            return
+        cut = f"{lines - limit + 1}.0"
+        if self.settings["spill_log"]:
+            with open(self.spill_path, "a" if self.spilled else "w") as file:
+                file.write(self.console_out.get("1.0", cut))
+            self.spilled = True
+        self.console_out.delete("1.0", cut)
+
     def do_stuff(self):
         for color in ["red", "yellow", "green"]:
             self.my_lovely_turtle.color(color)
@@ -316,6 +378,9 @@ class App:
 
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()  # Fractal worker processes, see parallel
+    print(helpers.license_notice())
     root = tk.Tk()
     app = App(root)
     root.mainloop()
@@ -0,0 +1,158 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Fractal geometry computed in worker processes.
+
+A big fractal is split into a coarse outline, computed here, and independent pieces (subtrees of a tree,
+stretches of a koch side) computed by a ProcessPoolExecutor. Pieces come back as packed array("d") buffers
+of x, y pairs and are merged in drawing order, giving the same path as the functions in geometry.
+
+Small fractals, and systems where processes can't be started, are computed in this process.
+"""
+__all__ = ["MINIMUM_POINTS", "worker_count", "tree_fractal", "koch_snowflake", "shutdown"]
+
+import typing
+import os
+import math
+import functools
+import multiprocessing
+from array import array
+from itertools import accumulate, chain
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import geometry
+
+Point = typing.Tuple[float, float]
+
+MINIMUM_POINTS = 1 << 17  # Fractals with fewer points are quicker to compute than to hand to other processes
+TASKS_PER_WORKER = 4  # Pieces take different times, smaller ones keep every process busy
+
+_executor = None
+_executor_workers = 0
+_unavailable = False  # Processes can't be started here
+
+
+def worker_count(workers: int) -> int:
+    """Number of processes to use, 0 or less means one per core"""
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+def shutdown():
+    """Stop the worker processes, they are started again when needed"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _map(function: typing.Callable, tasks: typing.List, workers: int) -> typing.Optional[typing.List[array]]:
+    """Run function over tasks in worker processes
+
+    :return: Results in task order, or None if they couldn't be computed in other processes
+    """
+    global _executor, _executor_workers, _unavailable
+    if _unavailable:
+        return None
+    try:
+        if _executor is not None and _executor_workers != workers:
+            shutdown()
+        if _executor is None:
+            # Forking a process that is running Tk and other threads isn't safe, start fresh ones instead
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return list(_executor.map(function, tasks))
+    except (OSError, NotImplementedError, ImportError):  # No multiprocessing support
+        _unavailable = True
+    except BrokenProcessPool:  # A process died, start new ones next time
+        _executor = None
+    return None
+
+
+def _unpack(buffer: array) -> typing.Iterator[Point]:
+    values = iter(buffer)
+    return zip(values, values)
+
+
+# Run in worker processes
+def _tree_piece(task: typing.Tuple[float, ...]) -> array:
+    x, y, heading, length, shorten_by, angle, minimum_length = task
+    points = geometry.tree_fractal((x, y), heading, length, shorten_by, angle, minimum_length, math.inf)
+    return array("d", chain.from_iterable(points[1:]))
+
+
+def _koch_piece(task: typing.Tuple[float, ...]) -> array:
+    x, y, heading, piece_length, level = task
+    points = geometry.koch_line(complex(x, y), heading, piece_length, level)
+    return array("d", chain.from_iterable((point.real, point.imag) for point in points))
+
+
+def tree_fractal(start: Point, heading: float, branch_length: float, shorten_by: float, angle: float,
+                 minimum_length: float = 5, maximum_branches: int = 2**22, workers: int = 0) -> typing.List[Point]:
+    """geometry.tree_fractal, with subtrees computed in worker processes
+
+    :param workers: Number of processes, see worker_count
+    """
+    workers = worker_count(workers)
+    levels = geometry.tree_fractal_levels(branch_length, shorten_by, minimum_length)
+    if workers < 2 or 2**levels < MINIMUM_POINTS or 2**levels - 1 > maximum_branches:
+        return geometry.tree_fractal(start, heading, branch_length, shorten_by, angle, minimum_length,
+                                     maximum_branches)
+    split = min(levels - 1, math.ceil(math.log2(workers * TASKS_PER_WORKER)))
+    outline = geometry.tree_fractal_split(start, heading, branch_length, shorten_by, angle, split, minimum_length)
+    tasks = [item + (shorten_by, angle, minimum_length) for item in outline if len(item) == 4]
+    pieces = iter(_map(_tree_piece, tasks, workers) or ())
+    points = []
+    for item in outline:
+        if len(item) == 2:
+            points.append(item)
+            continue
+        piece = next(pieces, None)
+        if piece is None:  # Couldn't use other processes
+            return geometry.tree_fractal(start, heading, branch_length, shorten_by, angle, minimum_length,
+                                         maximum_branches)
+        points.extend(_unpack(piece))
+    return points
+
+
+def _koch_line(start: complex, heading: float, piece_length: float, level: int,
+               split: int, workers: int) -> typing.List[complex]:
+    """geometry.koch_line, with the detail below split levels computed in worker processes"""
+    if level <= split:
+        return geometry.koch_line(start, heading, piece_length, level)
+    outline = geometry.koch_line(start, heading, piece_length * 3**(level - split), split)
+    headings = [heading + 60 * k for k in accumulate(geometry.koch_turns(split), initial=0)]
+    tasks = [(point.real, point.imag, piece_heading, piece_length, level - split)
+             for point, piece_heading in zip([start] + outline[:-1], headings)]
+    pieces = _map(_koch_piece, tasks, workers)
+    if pieces is None:
+        return geometry.koch_line(start, heading, piece_length, level)
+    return [complex(x, y) for piece in pieces for x, y in _unpack(piece)]
+
+
+def koch_snowflake(start: Point, heading: float, branch_length: float, sides: int, scale: float = 1.0,
+                   workers: int = 0) -> typing.List[Point]:
+    """geometry.koch_snowflake, with stretches of each side computed in worker processes
+
+    :param workers: Number of processes, see worker_count
+    """
+    workers = worker_count(workers)
+    level, _ = geometry.koch_level(branch_length)
+    if workers < 2 or sides * 4**level < MINIMUM_POINTS:
+        return geometry.koch_snowflake(start, heading, branch_length, sides, scale)
+    split = math.ceil(math.log(workers * TASKS_PER_WORKER, 4))
+    line = functools.partial(_koch_line, split=split, workers=workers)
+    return geometry.koch_snowflake(start, heading, branch_length, sides, scale, line)
@@ -0,0 +1,335 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Reading and writing saved command history.
+
+Two formats are supported, chosen by file extension:
+
+.txt -- one command per line, as typed
+
+.tsb -- compact binary, written and read one record at a time:
+    header: b"TSHB", version (u8), flags (u8, version 2 and up)
+    if flags has HAS_FRAME, the final drawing (see below)
+    one record per command:
+        varint (name id << 4 | argument count), 15 means the count follows as another varint
+        if the name id hasn't been seen before: varint length, utf-8 name
+        arguments, each a varint whose low 2 bits give its type:
+            0: zigzag int in the remaining bits
+            1: float64 follows
+            2: utf-8 text follows, length in the remaining bits
+            3: float32 follows
+    Varints are little-endian base 128. Numbers are only packed when they turn back into exactly the text typed.
+
+    The drawing is a frame, (canvas items, turtle state) as kept by a checkpoint:
+        varint length, turtle state as utf-8 json
+        varint item count, then for each item:
+            string item type, varint coordinate count, float32 coordinates,
+            varint option count, then string name and string value for each option
+    Strings in a frame are varint ids, an id that hasn't been seen before is followed by varint length and utf-8.
+"""
+__all__ = ["TEXT_EXTENSION", "BINARY_EXTENSION", "EXTENSIONS", "SaveFormatError",
+           "write_binary", "read_binary", "write_commands", "read_save", "read_commands"]
+
+import typing
+import struct
+import json
+from array import array
+
+TEXT_EXTENSION = ".txt"
+BINARY_EXTENSION = ".tsb"
+EXTENSIONS = [BINARY_EXTENSION, TEXT_EXTENSION]  # In order of preference when loading
+
+MAGIC = b"TSHB"
+VERSION = 2
+HAS_FRAME = 1
+BUFFER_SIZE = 64 * 1024
+
+_header = struct.Struct("<4sBB")
+_float64 = struct.Struct("<d")
+_float32 = struct.Struct("<f")
+INT, FLOAT64, TEXT, FLOAT32 = range(4)
+MANY_ARGUMENTS = 15
+
+# (canvas items, turtle state), see checkpoints.Checkpoint
+Frame = typing.Tuple[typing.List, typing.Dict[str, typing.Any]]
+
+
+class SaveFormatError(ValueError):
+    pass
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _pack_argument(out: bytearray, argument: str):
+    if (argument[1:] if argument.startswith("-") else argument).isdecimal():
+        number = int(argument)
+        if str(number) == argument:
+            _write_varint(out, (((number << 1) ^ -1 if number < 0 else number << 1) << 2) | INT)
+            return
+    try:
+        number = float(argument)
+        if repr(number) == argument:
+            packed = _float32.pack(number)
+            if _float32.unpack(packed)[0] == number:
+                out.append(FLOAT32)
+                out += packed
+            else:
+                out.append(FLOAT64)
+                out += _float64.pack(number)
+            return
+    except (ValueError, OverflowError):
+        pass
+    encoded = argument.encode("utf-8")
+    _write_varint(out, (len(encoded) << 2) | TEXT)
+    out += encoded
+
+
+def _write_string(out: bytearray, strings: typing.Dict[str, int], string: str):
+    string_id = strings.get(string)
+    if string_id is not None:
+        _write_varint(out, string_id)
+        return
+    strings[string] = len(strings)
+    _write_varint(out, len(strings) - 1)
+    encoded = string.encode("utf-8")
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _write_frame(file: typing.BinaryIO, out: bytearray, frame: Frame):
+    items, pen_state = frame
+    encoded = json.dumps(pen_state).encode("utf-8")
+    _write_varint(out, len(encoded))
+    out += encoded
+    _write_varint(out, len(items))
+    strings = {}
+    for kind, coords, options in items:
+        _write_string(out, strings, kind)
+        _write_varint(out, len(coords))
+        out += array("f", coords).tobytes()
+        _write_varint(out, len(options))
+        for name, value in options:
+            _write_string(out, strings, name)
+            _write_string(out, strings, value)
+        if len(out) >= BUFFER_SIZE:
+            file.write(out)
+            out.clear()
+
+
+def write_binary(file: typing.BinaryIO, commands: typing.Iterable[str], frame: Frame = None):
+    """Write commands, and optionally the drawing they make, to an open binary file, a buffer at a time"""
+    out = bytearray(_header.pack(MAGIC, VERSION, 0 if frame is None else HAS_FRAME))
+    if frame is not None:
+        _write_frame(file, out, frame)
+    names = {}
+    packed = {}  # argument -> encoding, arguments repeat a lot
+    for command in commands:
+        name, *arguments = command.split(" ")
+        name_id = names.get(name)
+        new_name = name_id is None
+        if new_name:
+            name_id = names[name] = len(names)
+        count = len(arguments)
+        _write_varint(out, (name_id << 4) | min(count, MANY_ARGUMENTS))
+        if count >= MANY_ARGUMENTS:
+            _write_varint(out, count)
+        if new_name:
+            encoded = name.encode("utf-8")
+            _write_varint(out, len(encoded))
+            out += encoded
+        for argument in arguments:
+            encoding = packed.get(argument)
+            if encoding is None:
+                encoding = bytearray()
+                _pack_argument(encoding, argument)
+                if len(packed) < 4096:
+                    packed[argument] = encoding
+            out += encoding
+        if len(out) >= BUFFER_SIZE:
+            file.write(out)
+            out.clear()
+    file.write(out)
+
+
+class _Reader:
+    """Buffered reader over a binary file"""
+
+    def __init__(self, file: typing.BinaryIO):
+        self.file = file
+        self.buffer = b""
+        self.position = 0
+
+    def _fill(self, size: int) -> bool:
+        """Make sure size bytes are available, False at a clean end of file"""
+        while len(self.buffer) - self.position < size:
+            data = self.file.read(BUFFER_SIZE)
+            if data == b"":
+                if self.position == len(self.buffer):
+                    return False
+                raise SaveFormatError("Save file ends in the middle of a record")
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+        return True
+
+    def at_end(self) -> bool:
+        return not self._fill(1)
+
+    def read(self, size: int) -> bytes:
+        if not self._fill(size):
+            raise SaveFormatError("Save file ends in the middle of a record")
+        data = self.buffer[self.position:self.position + size]
+        self.position += size
+        return data
+
+    def varint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            if self.position >= len(self.buffer) and not self._fill(1):
+                raise SaveFormatError("Save file ends in the middle of a record")
+            byte = self.buffer[self.position]
+            self.position += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+
+def _read_header(reader: _Reader) -> int:
+    """Check the header, returning its flags"""
+    magic = reader.read(len(MAGIC))
+    if magic != MAGIC:
+        raise SaveFormatError("Not a TurtleShell save file")
+    version = reader.read(1)[0]
+    if version == 1:  # Before frames, no flags
+        return 0
+    if version != VERSION:
+        raise SaveFormatError(f"Save file version {version} is not supported, expected {VERSION}")
+    return reader.read(1)[0]
+
+
+def _read_string(reader: _Reader, strings: typing.List[str]) -> str:
+    string_id = reader.varint()
+    if string_id == len(strings):
+        strings.append(reader.read(reader.varint()).decode("utf-8"))
+    elif string_id > len(strings):
+        raise SaveFormatError("String used before it was defined")
+    return strings[string_id]
+
+
+def _read_frame(reader: _Reader) -> Frame:
+    pen_state = json.loads(reader.read(reader.varint()).decode("utf-8"))
+    items = []
+    strings = []
+    for _ in range(reader.varint()):
+        kind = _read_string(reader, strings)
+        coords = array("f")
+        coords.frombytes(reader.read(4 * reader.varint()))
+        options = tuple((_read_string(reader, strings), _read_string(reader, strings)) for _ in range(reader.varint()))
+        items.append((kind, tuple(coords), options))
+    return items, pen_state
+
+
+def _read_records(reader: _Reader) -> typing.Iterator[str]:
+    names = []
+    while not reader.at_end():
+        head = reader.varint()
+        name_id = head >> 4
+        count = head & 0xF
+        if count == MANY_ARGUMENTS:
+            count = reader.varint()
+        if name_id == len(names):
+            names.append(reader.read(reader.varint()).decode("utf-8"))
+        elif name_id > len(names):
+            raise SaveFormatError("Command name used before it was defined")
+        parts = [names[name_id]]
+        for _ in range(count):
+            value = reader.varint()
+            kind = value & 3
+            if kind == INT:
+                value >>= 2
+                parts.append(str(-((value + 1) >> 1) if value & 1 else value >> 1))
+            elif kind == TEXT:
+                parts.append(reader.read(value >> 2).decode("utf-8"))
+            elif kind == FLOAT32:
+                parts.append(repr(_float32.unpack(reader.read(4))[0]))
+            else:
+                parts.append(repr(_float64.unpack(reader.read(8))[0]))
+        yield " ".join(parts)
+
+
+def read_binary(file: typing.BinaryIO) -> typing.Tuple[typing.Optional[Frame], typing.Iterator[str]]:
+    """Read the drawing (if saved) and then commands from an open binary file, a buffer at a time
+
+    :param file: File opened for binary reading
+    :return: (frame or None, iterator over commands)
+    """
+    reader = _Reader(file)
+    frame = _read_frame(reader) if _read_header(reader) & HAS_FRAME else None
+    return frame, _read_records(reader)
+
+
+def write_commands(file_path: str, commands: typing.Iterable[str], frame: Frame = None):
+    """Save commands, in the format matching the file's extension
+
+    :param file_path: File to write
+    :param commands: Commands, as typed
+    :param frame: Drawing to save with them, binary saves only
+    :return: None
+    """
+    if file_path.endswith(TEXT_EXTENSION):
+        with open(file_path, "w") as file:
+            file.writelines(command + "\n" for command in commands)
+    else:
+        with open(file_path, "wb") as file:
+            write_binary(file, commands, frame)
+
+
+def read_save(file_path: str) -> typing.Tuple[typing.Optional[Frame], typing.Iterator[str]]:
+    """Load a save, in the format matching the file's extension
+
+    The file is opened (and a binary header and frame read) straight away, so bad files raise before
+    iteration starts.
+
+    :param file_path: File to read
+    :return: (frame or None, iterator over commands, as typed)
+    """
+    if file_path.endswith(TEXT_EXTENSION):
+        file = open(file_path)
+        return None, _closing(file, (line.rstrip("\n") for line in file))
+    file = open(file_path, "rb")
+    try:
+        frame, commands = read_binary(file)
+    except Exception:  # noqa
+        file.close()
+        raise
+    return frame, _closing(file, commands)
+
+
+def read_commands(file_path: str) -> typing.Iterator[str]:
+    """Load just the commands from a save, see read_save"""
+    return read_save(file_path)[1]
+
+
+def _closing(file: typing.IO, lines: typing.Iterator[str]) -> typing.Iterator[str]:
+    with file:
+        yield from lines
@@ -0,0 +1,352 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Retained model of what is drawn on the canvas.
+
+Everything drawn is a Node: a polyline in turtle coordinates with its style, its bounding box, the canvas items
+showing it, and the number of history commands that had run once it was drawn. A Scene keeps nodes in drawing
+order and in a QuadTree, so they can also be found by area.
+
+Undoing the last few commands removes their nodes, and only their canvas items, instead of clearing the canvas
+and replaying history. Tk then repaints just the area those items covered.
+"""
+__all__ = ["STATE_LIMIT", "MIN_ZOOM", "MAX_ZOOM", "BBox", "overlaps", "Node", "QuadTree", "CommandStates", "Scene"]
+
+import typing
+import math
+from array import array
+import geometry
+
+STATE_LIMIT = 1000  # Commands that undo can go back without replaying
+MIN_ZOOM = 2.0 ** -12
+MAX_ZOOM = 2.0 ** 12
+
+BBox = typing.Tuple[float, float, float, float]  # x0, y0, x1, y1, in turtle coordinates
+# (item type, canvas coordinates, non-default options), see screens.CanvasScreen.snapshot_items
+CanvasItem = typing.Tuple[str, typing.Tuple[float, ...], typing.Tuple[typing.Tuple[str, str], ...]]
+
+
+def overlaps(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Node:
+    """Connected line segments drawn by one command"""
+    __slots__ = ("points", "colors", "width", "items", "bbox", "index", "number", "merged")
+
+    def __init__(self, points: array, colors: typing.Union[str, typing.Sequence[str]], width: float,
+                 items: typing.Sequence[int] = ()):
+        """Initialize a node
+
+        :param points: Flat x, y turtle coordinates, at least two points
+        :param colors: Line color, or the color of each segment
+        :param width: Line width
+        :param items: Canvas items showing the node
+        """
+        self.points = points
+        self.colors = colors
+        self.width = width
+        self.items = items
+        xs = points[0::2]
+        ys = points[1::2]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        self.index = None  # Set once the command drawing it has finished, see Scene.end_command
+        self.number = 0  # Position in drawing order, set by Scene.add
+        self.merged = None  # Zoom level -> points, see points_at
+
+    def __repr__(self) -> str:
+        return f"<Node of {len(self.points) // 2} points after {self.index} commands>"
+
+    def points_at(self, zoom: float) -> array:
+        """Points to draw at zoom
+
+        Zoomed out, points less than a pixel apart are merged. The result is cached for each power of two of zoom,
+        so zooming around doesn't merge again.
+
+        :param zoom: Canvas pixels per turtle unit
+        :return: Flat x, y turtle coordinates
+        """
+        if zoom >= 1 or not isinstance(self.colors, str):  # Segments with their own colors can't be merged
+            return self.points
+        level = math.floor(math.log2(zoom))
+        if self.merged is None:
+            self.merged = {}
+        points = self.merged.get(level)
+        if points is None:
+            points = geometry.merge_close_points(self.points, 2.0 ** -(level + 1))  # A pixel at most in the level
+            if len(points) == len(self.points):
+                points = self.points
+            self.merged[level] = points
+        return points
+
+    def canvas_items(self, xscale: float, yscale: float) -> typing.List[CanvasItem]:
+        """The node as canvas items, one per segment if segments have their own colors"""
+        coords = []
+        for i in range(0, len(self.points), 2):
+            coords.append(self.points[i] * xscale)
+            coords.append(-self.points[i + 1] * yscale)
+        width = ("width", str(float(self.width)))
+        if isinstance(self.colors, str):
+            return [("line", tuple(coords), (("fill", self.colors), width, ("capstyle", "round")))]
+        return [("line", tuple(coords[2 * i:2 * i + 4]), (("fill", color), width, ("capstyle", "round")))
+                for i, color in enumerate(self.colors)]
+
+
+class _Quad:
+    __slots__ = ("bounds", "depth", "nodes", "children")
+
+    def __init__(self, bounds: BBox, depth: int):
+        self.bounds = bounds
+        self.depth = depth
+        self.nodes = set()
+        self.children = None  # South-west, south-east, north-west, north-east
+
+    def child_for(self, bbox: BBox) -> typing.Optional["_Quad"]:
+        """Child quad that bbox fits in entirely, None if it crosses the middle"""
+        x0, y0, x1, y1 = self.bounds
+        middle_x = (x0 + x1) / 2
+        middle_y = (y0 + y1) / 2
+        if bbox[2] <= middle_x:
+            east = 0
+        elif bbox[0] >= middle_x:
+            east = 1
+        else:
+            return None
+        if bbox[3] <= middle_y:
+            north = 0
+        elif bbox[1] >= middle_y:
+            north = 2
+        else:
+            return None
+        return self.children[east + north]
+
+    def split(self):
+        x0, y0, x1, y1 = self.bounds
+        middle_x = (x0 + x1) / 2
+        middle_y = (y0 + y1) / 2
+        self.children = [_Quad(bounds, self.depth + 1) for bounds in [(x0, y0, middle_x, middle_y),
+                                                                      (middle_x, y0, x1, middle_y),
+                                                                      (x0, middle_y, middle_x, y1),
+                                                                      (middle_x, middle_y, x1, y1)]]
+        nodes = self.nodes
+        self.nodes = set()
+        for node in nodes:
+            child = self.child_for(node.bbox)
+            (self if child is None else child).nodes.add(node)
+
+
+class QuadTree:
+    """Finds nodes by bounding box
+
+    Each node is kept in the smallest quad it fits in entirely, nodes crossing a quad's middle stay in that quad.
+    The tree grows to fit what is added. Quads that empty out aren't merged, the area is likely drawn on again.
+    """
+    CAPACITY = 16  # Nodes a quad holds before it splits
+    MAX_DEPTH = 24
+    MAX_SIZE = 2.0 ** 64  # Bigger drawings are kept at the top, without growing further
+
+    def __init__(self, size: float = 1024.0):
+        """Initialize an empty tree
+
+        :param size: Width and height of the area around the origin to start with
+        """
+        self._root = _Quad((-size / 2, -size / 2, size / 2, size / 2), 0)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def insert(self, node: Node):
+        if not self._fits(node.bbox, self._root.bounds):
+            self._grow(node.bbox)
+        quad = self._root
+        if self._fits(node.bbox, quad.bounds):
+            while True:
+                if quad.children is None:
+                    if len(quad.nodes) < self.CAPACITY or quad.depth >= self.MAX_DEPTH:
+                        break
+                    quad.split()
+                child = quad.child_for(node.bbox)
+                if child is None:
+                    break
+                quad = child
+        quad.nodes.add(node)
+        self._count += 1
+
+    def remove(self, node: Node) -> bool:
+        """Remove node, following the same path insert took
+
+        :return: Whether node was in the tree
+        """
+        quad = self._root
+        while quad is not None:
+            if node in quad.nodes:
+                quad.nodes.remove(node)
+                self._count -= 1
+                return True
+            if quad.children is None:
+                return False
+            quad = quad.child_for(node.bbox)
+        return False
+
+    def find(self, bbox: BBox) -> typing.List[Node]:
+        """Nodes whose bounding box overlaps bbox, in no particular order"""
+        found = []
+        quads = [self._root]
+        while len(quads) > 0:
+            quad = quads.pop()
+            found.extend(node for node in quad.nodes if overlaps(node.bbox, bbox))
+            if quad.children is not None:
+                quads.extend(child for child in quad.children if overlaps(child.bounds, bbox))
+        return found
+
+    def clear(self):
+        size = self._size()
+        self._root = _Quad((-size / 2, -size / 2, size / 2, size / 2), 0)
+        self._count = 0
+
+    def _size(self) -> float:
+        return self._root.bounds[2] - self._root.bounds[0]
+
+    @staticmethod
+    def _fits(bbox: BBox, bounds: BBox) -> bool:
+        return bounds[0] <= bbox[0] and bbox[2] <= bounds[2] and bounds[1] <= bbox[1] and bbox[3] <= bounds[3]
+
+    def _grow(self, bbox: BBox):
+        """Double the size of the tree, around the origin, until bbox fits or it reaches MAX_SIZE"""
+        size = self._size()
+        extent = 2 * max(abs(value) for value in bbox)
+        while size < extent and size < self.MAX_SIZE:
+            size *= 2
+        if size == self._size():  # Too big (or not a number), it is kept at the top
+            return
+        nodes = []
+        quads = [self._root]
+        while len(quads) > 0:
+            quad = quads.pop()
+            nodes.extend(quad.nodes)
+            quads.extend(quad.children or ())
+        self._root = _Quad((-size / 2, -size / 2, size / 2, size / 2), 0)
+        self._count = 0
+        for node in nodes:
+            self.insert(node)
+
+
+class CommandStates:
+    """Turtle state after each of the last few commands, so undo can go back to them without replaying"""
+
+    def __init__(self, limit: int = STATE_LIMIT):
+        """Initialize without any states
+
+        :param limit: Number of states to keep, older ones are forgotten first
+        """
+        self.limit = limit
+        self.states = {}  # index -> state, in ascending index order
+
+    def add(self, index: int, state: typing.Any):
+        """Remember state as the state after index commands, forgetting states after it"""
+        self.discard_after(index - 1)
+        self.states[index] = state
+        while len(self.states) > self.limit:
+            del self.states[next(iter(self.states))]
+
+    def get(self, index: int) -> typing.Any:
+        return self.states.get(index)
+
+    def discard_after(self, index: int):
+        while len(self.states) > 0 and next(reversed(self.states)) > index:
+            self.states.popitem()
+
+    def clear(self):
+        self.states.clear()
+
+
+class Scene:
+    """Everything drawn, as nodes, with the turtle state after recent commands"""
+
+    def __init__(self):
+        self.nodes: typing.List[Node] = []  # In drawing order
+        self.tree = QuadTree()
+        self.states = CommandStates()
+        self.other_items: typing.List[CanvasItem] = []  # Restored canvas items that aren't lines
+        self.item_count = 0  # Items and points canvas_items would give for the nodes
+        self.point_count = 0
+        self._added = 0
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def add(self, node: Node):
+        node.number = self._added
+        self._added += 1
+        self.nodes.append(node)
+        self.tree.insert(node)
+        self._count(node, 1)
+
+    def end_command(self, index: int, state: typing.Any):
+        """Attribute nodes added since the last call to the command that brought history to index commands
+
+        :param index: Number of history commands that have run
+        :param state: Turtle state after them
+        :return: None
+        """
+        for node in reversed(self.nodes):
+            if node.index is not None:
+                break
+            node.index = index
+        self.states.add(index, state)
+
+    def remove_after(self, index: int) -> typing.List[Node]:
+        """Remove nodes drawn after index commands, including those of a command that hasn't finished
+
+        :return: Removed nodes, newest first
+        """
+        removed = []
+        while len(self.nodes) > 0 and (self.nodes[-1].index is None or self.nodes[-1].index > index):
+            node = self.nodes.pop()
+            self.tree.remove(node)
+            self._count(node, -1)
+            removed.append(node)
+        self.states.discard_after(index)
+        return removed
+
+    def _count(self, node: Node, sign: int):
+        if isinstance(node.colors, str):
+            self.item_count += sign
+            self.point_count += sign * (len(node.points) // 2)
+        else:  # An item of two points per segment
+            self.item_count += sign * len(node.colors)
+            self.point_count += sign * 2 * len(node.colors)
+
+    def find(self, bbox: BBox) -> typing.List[Node]:
+        """Nodes whose bounding box overlaps bbox, in drawing order"""
+        return sorted(self.tree.find(bbox), key=lambda node: node.number)
+
+    def canvas_items(self, xscale: float = 1.0, yscale: float = 1.0) -> typing.List[CanvasItem]:
+        """Everything drawn as canvas items, in drawing order"""
+        items = []
+        for node in self.nodes:
+            items.extend(node.canvas_items(xscale, yscale))
+        return items + self.other_items
+
+    def clear(self):
+        self.nodes = []
+        self.tree.clear()
+        self.states.clear()
+        self.other_items = []
+        self.item_count = 0
+        self.point_count = 0
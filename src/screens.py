@@ -0,0 +1,298 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+__all__ = ["CanvasScreen"]
+
+import typing
+import turtle
+import tkinter as tk
+from array import array
+from itertools import chain
+from checkpoints import pen_state, estimate_size
+from scene import Scene, Node, BBox, CanvasItem, overlaps, MIN_ZOOM, MAX_ZOOM
+
+
+class CanvasScreen(turtle.TurtleScreen):
+    """TurtleScreen that keeps what is drawn in a scene.Scene, so it can be copied, restored and partly undone
+
+    Lines drawn directly become scene nodes straight away. Lines the turtles draw are taken over from them
+    when a command ends, see end_command. Only nodes near the view have canvas items, see set_view.
+    """
+    ITEM_TAG = "turtleshell"  # Tag for items in the scene, so reset() knows to remove them
+    MAX_LINE_POINTS = 1024  # Longer polylines are split, huge single items are slow to redraw
+    DELETE_CHUNK = 1000  # Items deleted per canvas call
+
+    CULL_MARGIN = 32  # Canvas pixels around the view where items are kept, so wide lines aren't cut off
+
+    def __init__(self, cv: tk.Canvas, *args, **kwargs):
+        self.scene = Scene()
+        super().__init__(cv, *args, **kwargs)
+        # Turtle coordinates shown by the canvas, only nodes near it have canvas items
+        self.view = (-self.canvwidth / 2 / self.xscale, -self.canvheight / 2 / self.yscale,
+                     self.canvwidth / 2 / self.xscale, self.canvheight / 2 / self.yscale)
+
+    def _cull_area(self) -> BBox:
+        x0, y0, x1, y1 = self.view
+        margin_x = self.CULL_MARGIN / self.xscale
+        margin_y = self.CULL_MARGIN / self.yscale
+        return x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y
+
+    def _create_items(self, node: Node) -> array:
+        """Create the canvas items showing node
+
+        :return: Item ids
+        """
+        xscale = self.xscale
+        yscale = -self.yscale
+        points = node.points_at(xscale)
+        if isinstance(node.colors, str):
+            coords = [value * (xscale if i % 2 == 0 else yscale) for i, value in enumerate(points)]
+            return array("I", [self.cv.create_line(*coords, fill=node.colors, width=node.width, capstyle=tk.ROUND,
+                                                   tags=self.ITEM_TAG)])
+        # One item per segment, straight to Tcl, create_line's option handling would take longer than drawing
+        call = self.cv.tk.call
+        name = self.cv._w  # noqa
+        width = node.width
+        items = array("I")
+        x0 = points[0] * xscale
+        y0 = points[1] * yscale
+        for i, color in enumerate(node.colors, 1):
+            x1 = points[2 * i] * xscale
+            y1 = points[2 * i + 1] * yscale
+            items.append(int(call(name, "create", "line", x0, y0, x1, y1, "-fill", color, "-width", width,
+                                  "-capstyle", tk.ROUND, "-tags", self.ITEM_TAG)))
+            x0 = x1
+            y0 = y1
+        return items
+
+    def _add_node(self, node: Node):
+        """Add node to the scene, with canvas items if it is in view"""
+        node.items = self._create_items(node) if overlaps(node.bbox, self._cull_area()) else array("I")
+        self.scene.add(node)
+
+    def draw_polyline(self, points: typing.Sequence[typing.Tuple[float, float]], color: str, width: float):
+        """Draw connected line segments directly on the canvas
+
+        :param points: Turtle coordinates to connect, in order
+        :param color: Line color
+        :param width: Line width
+        :return: None
+        """
+        step = self.MAX_LINE_POINTS - 1
+        for start in range(0, max(len(points) - 1, 1), step):
+            chunk = points[start:start + step + 1]  # Chunks share their end points
+            if len(chunk) >= 2:
+                self._add_node(Node(array("d", chain.from_iterable(chunk)), color, width))
+
+    def draw_segments(self, points: typing.Sequence[typing.Tuple[float, float]], colors: typing.Sequence[str],
+                      width: float):
+        """Draw connected line segments directly on the canvas, each in its own color
+
+        :param points: Turtle coordinates to connect, in order
+        :param colors: Color of each segment, one fewer than points
+        :param width: Line width
+        :return: None
+        """
+        if len(colors) > 0:
+            self._add_node(Node(array("d", chain.from_iterable(points[:len(colors) + 1])), colors, width))
+
+    def set_view(self, view: BBox, zoom: float = None):
+        """Change the area that is shown, keeping canvas items only for nodes in or near it
+
+        Items for nodes that come into view are created on the spot, those for nodes that leave it are deleted.
+
+        :param view: x0, y0, x1, y1 in turtle coordinates
+        :param zoom: Canvas pixels per turtle unit, items in view are created again if it changes
+        :return: None
+        """
+        old_area = self._cull_area()
+        rezoom = zoom is not None and zoom != self.xscale
+        if rezoom:
+            self.xscale = self.yscale = zoom
+        self.view = view
+        area = self._cull_area()
+        for node in self.scene.tree.find(old_area):
+            if len(node.items) > 0 and (rezoom or not overlaps(node.bbox, area)):
+                self._delete_items(node.items)
+                node.items = array("I")
+        above = None  # Next node in drawing order that has items
+        for node in reversed(self.scene.find(area)):
+            if len(node.items) == 0:
+                node.items = self._create_items(node)
+                if above is not None:  # Stack it below later drawing, not on top
+                    for item in node.items:
+                        self.cv.tag_lower(item, above.items[0])
+            above = node
+        for pen in self.turtles():
+            self.cv.tag_raise(pen.currentLineItem)
+        x0, y0, x1, y1 = view
+        self.cv.config(scrollregion=(x0 * self.xscale, -y1 * self.yscale, x1 * self.xscale, -y0 * self.yscale))
+        if rezoom:
+            self.update()  # Redraw the turtles at the new size
+
+    def look_at(self, x: float, y: float, zoom: float) -> typing.Tuple[float, float, float]:
+        """Show the canvas centered on x, y at zoom
+
+        :param x: Turtle x coordinate for the center
+        :param y: Turtle y coordinate for the center
+        :param zoom: Canvas pixels per turtle unit, limited to scene.MIN_ZOOM and scene.MAX_ZOOM
+        :return: (x, y, zoom) shown
+        """
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        half_width = self.canvwidth / 2 / zoom
+        half_height = self.canvheight / 2 / zoom
+        self.set_view((x - half_width, y - half_height, x + half_width, y + half_height), zoom)
+        return x, y, zoom
+
+    def view_center(self) -> typing.Tuple[float, float]:
+        x0, y0, x1, y1 = self.view
+        return (x0 + x1) / 2, (y0 + y1) / 2
+
+    def pan_view(self, dx: float, dy: float) -> typing.Tuple[float, float, float]:
+        """Move the view dx canvas pixels right and dy up, see look_at"""
+        x, y = self.view_center()
+        return self.look_at(x + dx / self.xscale, y + dy / self.yscale, self.xscale)
+
+    def zoom_view(self, factor: float) -> typing.Tuple[float, float, float]:
+        """Zoom in by factor around the center of the view, see look_at"""
+        x, y = self.view_center()
+        return self.look_at(x, y, self.xscale * factor)
+
+    def reset_view(self) -> typing.Tuple[float, float, float]:
+        """Show the origin at the original size, see look_at"""
+        return self.look_at(0.0, 0.0, 1.0)
+
+    def view_area(self) -> typing.Tuple[BBox, float]:
+        """Turtle coordinates shown by the canvas, and the zoom they are shown at"""
+        return self.view, self.xscale
+
+    # Export
+    def drawn_lines(self) -> typing.List[typing.Tuple[array, typing.Union[str, typing.Sequence[str]], float]]:
+        """Everything the turtles (and we) have drawn, without creating canvas items
+
+        :return: (flat x, y turtle coordinates, color or one color per segment, width) in drawing order
+        """
+        self._take_turtle_lines()
+        return [(node.points, node.colors, node.width) for node in self.scene.nodes]
+
+    def color_rgb(self, color: str) -> bytes:
+        """Any color Tk knows as 3 bytes of RGB, raster.parse_color is quicker for #rrggbb colors"""
+        return bytes(value >> 8 for value in self.cv.winfo_rgb(color))
+
+    def _take_turtle_lines(self):
+        """Turn the lines turtles have drawn into scene nodes, with their items tagged as ours"""
+        cv = self.cv
+        for pen in self.turtles():
+            pen._newLine()  # noqa, finish the line being drawn, later moves start a new item
+            kept = [pen.currentLineItem]
+            for item in pen.items:
+                if item == pen.currentLineItem:
+                    continue
+                if cv.type(item) != "line":
+                    kept.append(item)
+                    continue
+                coords = cv.coords(item)
+                if len(coords) < 4:  # Nothing drawn
+                    cv.delete(item)
+                    continue
+                values = iter(coords)
+                points = array("d", chain.from_iterable((x / self.xscale, -y / self.yscale)
+                                                         for x, y in zip(values, values)))
+                node = Node(points, cv.itemcget(item, "fill"), float(cv.itemcget(item, "width")))
+                if overlaps(node.bbox, self._cull_area()):
+                    cv.addtag_withtag(self.ITEM_TAG, item)
+                    node.items = array("I", [item])
+                else:  # Off screen, it is created again if it comes into view
+                    cv.delete(item)
+                    node.items = array("I")
+                self.scene.add(node)
+            pen.items = kept
+
+    def _delete_items(self, items: typing.Sequence[int]):
+        for start in range(0, len(items), self.DELETE_CHUNK):
+            self.cv.delete(*items[start:start + self.DELETE_CHUNK])
+
+    def end_command(self, index: int):
+        """Mark what has been drawn since the last call as drawn by the first index history commands
+
+        Also remembers the turtle state, so rewind can go back to it.
+
+        :param index: Number of history commands that have run
+        :return: None
+        """
+        self._take_turtle_lines()
+        turtles = self.turtles()
+        self.scene.end_command(index, pen_state(turtles[0], self) if len(turtles) > 0 else None)
+
+    def rewind(self, index: int) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Remove everything drawn after index commands, by deleting just those canvas items
+
+        :param index: Number of history commands to go back to
+        :return: Turtle state after index commands, None if it is no longer known, then nothing is removed
+        """
+        state = self.scene.states.get(index)
+        if state is None:
+            return None
+        for pen in self.turtles():  # Lines from a command that didn't finish
+            pen._newLine()  # noqa
+            self._delete_items([item for item in pen.items if item != pen.currentLineItem])
+            pen.items = [pen.currentLineItem]
+        for node in self.scene.remove_after(index):
+            self._delete_items(node.items)
+        return state
+
+    def snapshot_size(self) -> int:
+        """Rough number of bytes snapshot_items would copy, without copying them"""
+        self._take_turtle_lines()
+        others = self.scene.other_items
+        return estimate_size(self.scene.item_count + len(others),
+                             self.scene.point_count + sum(len(coords) // 2 for _, coords, _ in others))
+
+    def snapshot_items(self) -> typing.List[CanvasItem]:
+        """Copy everything drawn
+
+        Turtle shapes are not included, only what the turtles (and we) have drawn.
+
+        :return: Items in stacking order, with their coordinates at zoom 1
+        """
+        self.update()  # Make sure pending turtle lines have reached the canvas
+        self._take_turtle_lines()
+        return self.scene.canvas_items()  # At zoom 1, so they can be restored at any zoom
+
+    def restore_items(self, items: typing.Iterable[CanvasItem]):
+        """Recreate items taken from snapshot_items
+
+        :param items: Items to draw, with their coordinates at zoom 1
+        :return: None
+        """
+        self.cv.delete(self.ITEM_TAG)
+        self.scene.clear()
+        for kind, coords, options in items:
+            if kind == "line":
+                options = dict(options)
+                values = iter(coords)
+                self.draw_polyline([(x, -y) for x, y in zip(values, values)],
+                                   options.get("fill", "black"), float(options.get("width", 1.0)))
+                continue
+            create = getattr(self.cv, "create_" + kind)
+            self.cv.scale(create(*coords, tags=self.ITEM_TAG, **dict(options)), 0, 0, self.xscale, self.yscale)
+            self.scene.other_items.append((kind, coords, options))
+        self.cv.tag_lower(self.ITEM_TAG)  # Keep below anything the turtles draw afterwards
+
+    def reset(self):
+        self.cv.delete(self.ITEM_TAG)
+        self.scene.clear()
+        super().reset()
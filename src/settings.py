@@ -0,0 +1,129 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+__all__ = ["Settings", "render_tracer"]
+
+import typing
+import json
+import os
+import helpers
+
+
+def _to_bool(string: str) -> bool:
+    lowered = string.lower()
+    if lowered in ("true", "yes", "on", "1"):
+        return True
+    elif lowered in ("false", "no", "off", "0"):
+        return False
+    raise ValueError(f"Expected true or false, got {string}")
+
+
+def render_tracer(mode: str) -> typing.Optional[int]:
+    """Screen tracer value for a rendering mode
+
+    :param mode: animate, batch, or a number of segments to draw between screen updates
+    :return: Tracer value, or None to leave the screen animating as it is
+    """
+    if mode == "animate":
+        return None
+    if mode == "batch":
+        return 0
+    if not mode.isdecimal() or int(mode) < 1:
+        raise ValueError(f"Rendering mode must be animate, batch, or a positive number, not {mode}")
+    return int(mode)
+
+
+class Settings:
+    """User settings, stored as json next to the program"""
+    DEFAULTS = {
+        "scrollback_lines": 5000,  # Console lines to keep, 0 for unlimited
+        "spill_log": False,  # Write lines trimmed from the console to console_spill.log
+        "save_frames": True,  # Save the finished drawing with the commands, so loading doesn't replay them
+        "workers": 0,  # Processes used for big fractals, 0 for one per core, 1 to only use the main process
+        "render": "animate"  # How commands show their drawing, see render_tracer
+    }
+    CHECKS = {  # Setting -> function that raises ValueError for values it can't have
+        "render": render_tracer
+    }
+
+    LICENSE_KEY = "accepted_license"  # Stored alongside the settings, but not one the user can change
+
+    def __init__(self, file_name: str = ".settings.json"):
+        """Load settings, falling back to defaults for anything missing
+
+        :param file_name: File to store settings in
+        """
+        self.file_path = helpers.external_path(file_name)
+        self.values = dict(self.DEFAULTS)
+        self.accepted_license = None  # Version of the license the user accepted
+        stored = {}
+        try:
+            with open(self.file_path) as file:
+                stored = json.load(file)
+        except (FileNotFoundError, ValueError):
+            pass
+        for name, value in stored.items():
+            if name in self.values:
+                self.values[name] = value
+        self.accepted_license = stored.get(self.LICENSE_KEY)
+        if self.accepted_license is None:
+            self._migrate_license()
+
+    def _migrate_license(self):
+        """Move license acceptance out of .license_accepted.txt, where it was kept before settings existed"""
+        old_path = helpers.external_path(".license_accepted.txt")
+        try:
+            with open(old_path) as file:
+                self.accepted_license = file.read().split("\n")[0]
+        except FileNotFoundError:
+            return
+        self.save()
+        os.remove(old_path)
+
+    def has_accepted_license(self) -> bool:
+        """Check whether user has accepted our license"""
+        return self.accepted_license == helpers.LICENSE_VERSION
+
+    def accept_license(self):
+        """Record that the user has accepted the latest license"""
+        self.accepted_license = helpers.LICENSE_VERSION
+        self.save()
+
+    def __getitem__(self, name: str) -> typing.Any:
+        return self.values[name]
+
+    def set(self, name: str, value: str):
+        """Change a setting from user input and save it
+
+        :param name: Setting to change
+        :param value: New value, converted to the setting's type
+        :return: None
+        """
+        if name not in self.DEFAULTS:
+            raise KeyError(f"No setting named {name}")
+        kind = type(self.DEFAULTS[name])
+        converted = _to_bool(value) if kind == bool else kind(value)
+        if name in self.CHECKS:
+            self.CHECKS[name](converted)
+        self.values[name] = converted
+        self.save()
+
+    def save(self):
+        stored = dict(self.values)
+        if self.accepted_license is not None:
+            stored[self.LICENSE_KEY] = self.accepted_license
+        with open(self.file_path, "w") as file:
+            json.dump(stored, file, indent=4)
@@ -18,8 +18,11 @@ __all__ = ["StandardCommandSet"]
 
 import turtle
 import typing
+import time
 from callbacks import TurtleCallbacks
 from command_lib import CommandSet, Command
+from settings import Settings
+from colorama import Fore, Style
 from helpers import error_format, error_string, rr
 
 
@@ -29,7 +32,9 @@ class StandardCommandSet:
                  screen: turtle.TurtleScreen,
                  quit_callback: typing.Callable[[None], None],
                  output_callback: typing.Callable[[str], None],
-                 clear_console: typing.Callable[[None], None]):
+                 clear_console: typing.Callable[[None], None],
+                 settings: Settings = None,
+                 wait: typing.Callable[[float], None] = time.sleep):
         """Create a standard set of commands for turtle interaction
         
         :param pen: Turtle to draw with
@@ -37,14 +42,17 @@ class StandardCommandSet:
         :param quit_callback: Callback to quit program
         :param output_callback: Callback to send command output to
         :param clear_console: Callback to clear output
+        :param settings: User settings, loaded from disk if not given
+        :param wait: Used by sleep to wait, see TurtleCallbacks
         """
         self.pen = pen
         self.screen = screen
         self.quit_callback = quit_callback
         self.output_callback = output_callback
+        self.settings = settings if settings is not None else Settings()
 
-        self.call = TurtleCallbacks(self.pen, self.screen, self.output_callback, clear_console)
-        self.commandSet = CommandSet(self.output_callback, self.call)
+        self.call = TurtleCallbacks(self.pen, self.screen, self.output_callback, clear_console, wait, self.settings)
+        self.commandSet = CommandSet(self.output_callback, self.call, self.settings)
 
         self.commandSet.register(Command("penup", "Raise pen", 0, [], self.call.penup))
         self.commandSet.register(Command("pendown", "Lower pen", 0, [], self.call.pendown))
@@ -87,6 +95,8 @@ class StandardCommandSet:
 
         self.commandSet.register(Command("random", "Plot 20 random lines", 0, [], self.call.random, [20]))
         self.commandSet.register(Command("random", "Plot ```number``` random lines", 1, [int], self.call.random))
+        self.commandSet.register(Command("random", "Plot ```number``` random lines, the same ones every time for the same ```seed```",
+                                         2, [int, int], self.call.random))
         self.commandSet.help_break()
 
         self.commandSet.register(Command(
@@ -133,6 +143,23 @@ class StandardCommandSet:
         self.commandSet.alias("snowflake", "snow")
         self.commandSet.help_break()
 
+        self.commandSet.register(Command("lsystem", "List L-systems", 0, [], self.call.lsystems))
+        self.commandSet.register(Command(
+            "lsystem",
+            "Plot L-system ```name``` rewritten ```depth``` times, with steps of 5",
+            2,
+            [str, int],
+            self.call.lsystem
+        ))
+        self.commandSet.register(Command(
+            "lsystem",
+            "Plot L-system ```name``` rewritten ```depth``` times, with steps of ```length```",
+            3,
+            [str, int, float],
+            self.call.lsystem
+        ))
+        self.commandSet.help_break()
+
         self.commandSet.register(Command("color", "Set pen to ```color```", 1, [str], self.call.color))
         self.commandSet.register(Command("bgcolor", "Set background to ```color```", 1, [str], self.call.bgcolor))
         self.commandSet.alias("bgcolor", "bg")
@@ -152,15 +179,55 @@ class StandardCommandSet:
         self.commandSet.register(Command("heading", "Show pen's heading", 0, [], self.call.heading))
         self.commandSet.help_break()
 
+        self.commandSet.register(Command("pan", "Move the view ```x``` pixels right and ```y``` pixels up", 2, [int, int],
+                                         self.call.pan))
+        self.commandSet.register(Command("zoom", "Go back to the original view", 0, [], self.call.reset_view))
+        self.commandSet.register(Command("zoom", "Zoom in by ```factor```, less than 1 zooms out", 1, [float],
+                                         self.call.zoom))
+        self.commandSet.history_keeper.ignored.update({"pan", "zoom"})  # Only change the view
+        self.commandSet.help_break()
+
+        self.commandSet.register(Command("export", "Save the view as image ```file``` (.png or .ppm)", 1, [str],
+                                         self.call.export))
+        self.commandSet.register(Command("export", "Save the view as image ```file```, ```scale``` times bigger", 2,
+                                         [str, float], self.call.export))
+        self.commandSet.history_keeper.ignored.add("export")
+        self.commandSet.help_break()
+
         self.commandSet.register(Command("reset", "Reset everything", 0, [], self.call.reset))
         self.commandSet.register(Command("clear", "Clear console", 0, [], self.call.clear))
         self.commandSet.help_break()
 
+        self.commandSet.register(Command("setting", "List settings", 0, [], self.show_settings))
+        self.commandSet.register(Command("setting", "Show ```name``` setting", 1, [str], self.show_settings))
+        self.commandSet.register(Command("setting", "Change ```name``` setting to ```value```", 2, [str, str],
+                                         self.change_setting))
+        self.commandSet.alias("setting", "settings")
+        self.commandSet.history_keeper.ignored.update({"setting", "settings"})
+        self.commandSet.help_break()
+
         self.commandSet.register(Command("quit", "Close the canvas", 0, [], self.quit_callback))
         self.commandSet.alias("quit", "exit")
 
         self.commandSet.register(Command("rr", "Never gonna give you up...", 0, [], rr), False)
 
+    def show_settings(self, name: str = None):
+        names = list(self.settings.values) if name is None else [name]
+        for setting in names:
+            self.output_callback(f"{Fore.GREEN}{setting}{Style.RESET_ALL} = {self.settings[setting]}")
+
+    def change_setting(self, name: str, value: str):
+        self.settings.set(name, value)
+        self.show_settings(name)
+
+    def run_script(self, script: str):
+        """Run a multi-line script as one batch, see CommandSet.run_script
+
+        :param script: Commands, one per line
+        :return: None
+        """
+        self.commandSet.run_script(script)
+
     def user_input(self, string: str):
         """Run command from user input
 
@@ -168,7 +235,10 @@ class StandardCommandSet:
         :return: None
         """
         try:
-            self.commandSet.execute(string)
+            if "\n" in string.strip():  # Pasted several lines, run them as one script
+                self.run_script(string)
+            else:
+                self.commandSet.execute(string)
         except Exception as e:  # noqa
             problem = f"Something went wrong while executing command [{string}]:\n\t"
             problem += error_string(e)
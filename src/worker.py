@@ -0,0 +1,232 @@
+"""
+Copyright (C) 2022  Sam Wagenaar
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+Running commands on a background thread, so the window stays responsive while they run.
+
+Tk may only be used from the thread running mainloop. Commands get MainThreadProxy objects in place of the
+pen and screen, calls made through them are queued and run by CommandWorker on the main thread, a frame's
+worth at a time, from an after() callback.
+
+Calls that only change something are queued without waiting, so drawing doesn't need a round trip per call.
+An error from one of those is raised by the next call the command makes through a proxy.
+"""
+__all__ = ["CommandWorker", "MainThreadProxy", "QUERIES", "GETTERS"]
+
+import typing
+import time
+import threading
+import tkinter as tk
+from queue import Queue, Empty
+from command_lib import CommandCancelled
+
+# Methods that always return something the caller needs
+QUERIES = {"pos", "position", "xcor", "ycor", "heading", "isdown", "isvisible", "distance", "towards",
+           "getshapes", "turtles", "snapshot_items", "update", "rewind", "pan_view", "zoom_view",
+           "reset_view", "view_area", "drawn_lines", "color_rgb", "snapshot_size"}
+# Methods that return something only when called without arguments
+GETTERS = {"color", "pencolor", "fillcolor", "width", "pensize", "shape", "speed", "pen",
+           "delay", "tracer", "bgcolor", "mode", "colormode"}
+
+
+class _Call:
+    """Function call waiting to run on the main thread"""
+    __slots__ = ("function", "args", "kwargs", "done", "result", "error")
+
+    def __init__(self, function: typing.Callable, args: tuple, kwargs: dict, wait: bool):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event() if wait else None
+        self.result = None
+        self.error = None
+
+
+class CommandWorker:
+    """Runs jobs one at a time on a background thread, and their Tk calls on the main thread"""
+
+    def __init__(self, master: tk.Misc, frame_ms: int = 16):
+        """Start the worker thread, must be called from the main thread
+
+        :param master: Widget used to schedule polling
+        :param frame_ms: Each poll runs queued calls for up to half of this many milliseconds
+        """
+        self.master = master
+        self.frame_ms = frame_ms
+        self.main_thread = threading.current_thread()
+        self.calls = Queue()  # _Call objects for the main thread
+        self.jobs = Queue()  # (job, finished) for the worker thread
+        self.cancel_event = threading.Event()
+        self.busy = False
+        self.error = None  # Raised by a call that didn't wait, not yet reported to the worker
+        self.polling = False
+        self.thread = threading.Thread(target=self._run_jobs, name="commands", daemon=True)
+        self.thread.start()
+
+    def proxy(self, target: typing.Any) -> "MainThreadProxy":
+        return MainThreadProxy(target, self)
+
+    def on_main(self, function: typing.Callable) -> typing.Callable:
+        """Wrap function so calling it from the worker thread queues it for the main thread instead"""
+        def call(*args, **kwargs):
+            return self.call(function, args, kwargs, False)
+        return call
+
+    def call(self, function: typing.Callable, args: tuple, kwargs: dict, wait: bool) -> typing.Any:
+        """Run function on the main thread
+
+        :param function: Function to run
+        :param args: Positional arguments
+        :param kwargs: Keyword arguments
+        :param wait: Wait for and return the result, otherwise return None straight away
+        :return: Result of function, if waited for
+        """
+        if threading.current_thread() is self.main_thread:
+            return function(*args, **kwargs)
+        if self.cancel_event.is_set():
+            self.cancel_event.clear()  # Only cancel once, cleaning up after the command may need the screen
+            raise CommandCancelled()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        call = _Call(function, args, kwargs, wait)
+        self.calls.put(call)
+        if not wait:
+            return None
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        if self.error is not None:  # From a call queued before this one
+            error, self.error = self.error, None
+            raise error
+        return call.result
+
+    def submit(self, job: typing.Callable[[], None], finished: typing.Callable[[typing.Optional[BaseException]], None]):
+        """Run job on the worker thread, must be called from the main thread
+
+        :param job: Function to run
+        :param finished: Called on the main thread once job and all its queued calls are done, with what job raised
+        :return: None
+        """
+        self.busy = True
+        self.cancel_event.clear()
+        self.error = None
+        self.jobs.put((job, finished))
+        self._schedule_poll(0)
+
+    def wait(self, seconds: float):
+        """Wait on the worker thread, stopping early if the job is cancelled
+
+        :param seconds: Time to wait
+        :return: None
+        """
+        deadline = time.monotonic() + seconds
+        remaining = seconds
+        while remaining > 0:
+            if self.cancel_event.wait(remaining):
+                self.cancel_event.clear()
+                raise CommandCancelled()
+            remaining = deadline - time.monotonic()  # Event.wait can return a little early
+
+    def cancel(self):
+        """Ask the running job to stop, at its next call through a proxy"""
+        if self.busy:
+            self.cancel_event.set()
+
+    def _run_jobs(self):
+        while True:
+            job, finished = self.jobs.get()
+            error = None
+            try:
+                job()
+            except BaseException as e:  # noqa, reported to finished
+                error = e
+            if error is None and self.error is not None:
+                error, self.error = self.error, None
+            self.calls.put(_Call(self._finish, (finished, error), {}, False))
+
+    def _finish(self, finished: typing.Callable[[typing.Optional[BaseException]], None], error: typing.Optional[BaseException]):
+        self.busy = False
+        self.cancel_event.clear()
+        finished(error)
+
+    def _schedule_poll(self, delay: int):
+        if self.polling:
+            return
+        self.polling = True
+        try:
+            self.master.after(delay, self._poll)
+        except tk.TclError:  # Window closed
+            self.polling = False
+
+    def _poll(self):
+        """Run queued calls for up to half a frame, then let Tk redraw and handle input
+
+        While a job is running, waits for more calls until the half frame is up, so queries get answered
+        straight away instead of on the next poll.
+        """
+        self.polling = False
+        deadline = time.perf_counter() + self.frame_ms / 2000
+        calls_left = True
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                call = self.calls.get(timeout=remaining) if self.busy else self.calls.get_nowait()
+            except Empty:
+                calls_left = False
+                break
+            try:
+                call.result = call.function(*call.args, **call.kwargs)
+            except Exception as e:  # noqa, passed back to the worker
+                if call.done is None:
+                    self.error = e
+                else:
+                    call.error = e
+            if call.done is not None:
+                call.done.set()
+        if calls_left or self.busy:
+            self._schedule_poll(1)
+
+
+class MainThreadProxy:
+    """Stands in for a pen or screen on the worker thread, running its methods on the main thread
+
+    Methods in QUERIES, and in GETTERS when called without arguments, wait for their result. Everything else
+    is queued and returns None. Attributes that aren't methods are read directly.
+    """
+
+    def __init__(self, target: typing.Any, worker: CommandWorker):
+        self._target = target
+        self._worker = worker
+        self._methods = {}
+
+    def __getattr__(self, name: str) -> typing.Any:
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        method = self._methods.get(name)
+        if method is None:
+            worker = self._worker
+            query = name in QUERIES
+            getter = name in GETTERS
+
+            def method(*args, **kwargs):
+                wait = query or (getter and len(args) == 0 and len(kwargs) == 0)
+                return worker.call(attribute, args, kwargs, wait)
+            self._methods[name] = method
+        return method
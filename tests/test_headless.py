@@ -0,0 +1,152 @@
+"""Tests for drawing without a display: undo, save round trips, and the structures they use
+
+Run from the repository root with ``python -m pytest tests`` or ``python -m unittest discover tests``.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import helpers  # noqa: E402
+from headless import HeadlessPen, HeadlessScreen  # noqa: E402
+from history_log import HistoryLog  # noqa: E402
+from scene import Node, QuadTree  # noqa: E402
+from standard_command_set import StandardCommandSet  # noqa: E402
+
+SCRIPT = [
+    "forward 40", "left 30", "color red", "forward 25", "width 3", "right 100",
+    "back 60", "penup", "goto 20 -35", "pendown", "color blue", "forward 15", "left 45", "forward 70"
+]
+
+
+class HeadlessCase(unittest.TestCase):
+    """Runs commands on a headless screen, with saves and settings kept in a temporary folder"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, "saves"))
+        self.external_path = helpers.external_path
+        helpers.external_path = lambda relative_path: os.path.join(self.folder, relative_path)
+        self.output = []
+        self.commands = self.command_set()
+
+    def tearDown(self):
+        helpers.external_path = self.external_path
+        shutil.rmtree(self.folder)
+
+    def command_set(self):
+        screen = HeadlessScreen()
+        return StandardCommandSet(HeadlessPen(screen), screen, lambda: None, self.output.append, lambda: None)
+
+    def run_commands(self, commands, lines):
+        for line in lines:
+            commands.commandSet.execute(line)
+
+    def drawing(self, commands):
+        screen = commands.screen
+        return list(screen.segments), [screen.palette[i] for i in screen.segment_colors], list(screen.segment_widths)
+
+    def assertDrawingAlmostEqual(self, first, second):
+        """Frames keep points in single precision, so a restored drawing is only close to the replayed one"""
+        self.assertEqual(first[1:], second[1:])
+        self.assertEqual(len(first[0]), len(second[0]))
+        for a, b in zip(first[0], second[0]):
+            self.assertAlmostEqual(a, b, places=4)
+
+    def history(self, commands):
+        return list(commands.commandSet.history_keeper.history)
+
+
+class TestUndo(HeadlessCase):
+    def test_undo_matches_replay(self):
+        self.run_commands(self.commands, SCRIPT)
+        for undone in range(1, len(SCRIPT) + 1):
+            self.commands.commandSet.execute("undo")
+            fresh = self.command_set()
+            self.run_commands(fresh, SCRIPT[:-undone])
+            self.assertEqual(self.history(self.commands), SCRIPT[:-undone])
+            self.assertEqual(self.drawing(self.commands), self.drawing(fresh))
+
+    def test_undo_after_script(self):
+        self.commands.commandSet.run_script("\n".join(SCRIPT))
+        self.commands.commandSet.execute("undo")
+        fresh = self.command_set()
+        self.run_commands(fresh, SCRIPT[:-1])
+        self.assertEqual(self.drawing(self.commands), self.drawing(fresh))
+
+
+class TestSaves(HeadlessCase):
+    def round_trip(self, name, save_frames):
+        self.commands.settings.values["save_frames"] = save_frames
+        self.run_commands(self.commands, SCRIPT)
+        drawn = self.drawing(self.commands)
+        self.commands.commandSet.execute(f"save {name}")
+        self.commands.commandSet.execute("reset")
+        self.assertEqual(self.history(self.commands), [])
+        self.commands.commandSet.execute(f"load {name}")
+        self.assertEqual(self.history(self.commands), SCRIPT)
+        self.assertDrawingAlmostEqual(self.drawing(self.commands), drawn)
+
+    def test_binary_round_trip(self):
+        self.round_trip("drawing", False)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "saves", "drawing.tsb")))
+
+    def test_binary_round_trip_with_frame(self):
+        self.round_trip("drawing", True)
+
+    def test_text_round_trip(self):
+        self.round_trip("drawing.txt", True)
+        with open(os.path.join(self.folder, "saves", "drawing.txt")) as file:
+            self.assertEqual(file.read().split("\n")[:len(SCRIPT)], SCRIPT)
+
+    def test_truncated_load_keeps_history(self):
+        self.run_commands(self.commands, SCRIPT)
+        self.commands.commandSet.execute("save drawing")
+        file_path = os.path.join(self.folder, "saves", "drawing.tsb")
+        with open(file_path, "r+b") as file:
+            file.truncate(os.path.getsize(file_path) // 2)
+        self.run_commands(self.commands, ["reset", "forward 7"])
+        drawn = self.drawing(self.commands)
+        self.output.clear()
+        self.commands.commandSet.execute("load drawing")
+        self.assertEqual(self.history(self.commands), ["forward 7"])
+        self.assertEqual(self.drawing(self.commands), drawn)
+        self.assertTrue(any("SaveFormatError" in line for line in self.output), self.output)
+
+
+class TestHistoryLog(unittest.TestCase):
+    def test_append_pop_truncate(self):
+        log = HistoryLog(["forward 10", "left 90"])
+        try:
+            log.extend(["color red", "forward 5"])
+            self.assertEqual(len(log), 4)
+            self.assertEqual(log[-1], "forward 5")
+            self.assertEqual(log.pop(), "forward 5")
+            log.truncate(1)
+            self.assertEqual(list(log), ["forward 10"])
+            log.clear()
+            self.assertEqual(list(log), [])
+        finally:
+            log.close()
+
+
+class TestQuadTree(unittest.TestCase):
+    def test_find(self):
+        tree = QuadTree(64.0)
+        near = Node(array("d", [0, 0, 10, 10]), "black", 1.0)
+        far = Node(array("d", [500, 500, 520, 510]), "black", 1.0)  # Outside the first size, grows the tree
+        tree.insert(near)
+        tree.insert(far)
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(tree.find((-5, -5, 5, 5)), [near])
+        self.assertEqual(tree.find((505, 505, 506, 506)), [far])
+        self.assertTrue(tree.remove(near))
+        self.assertEqual(tree.find((-5, -5, 5, 5)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()